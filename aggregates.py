@@ -0,0 +1,281 @@
+import numpy as np
+import pandas as pd
+
+from load_data import *
+from cache import *
+from product_index import *
+
+NUM_REVIEWS = 'numReviews'
+
+# metrics aggregated per product and per period and product
+AGGREGATE_METRICS = [RATING, REVIEW_WORD_COUNT, HELPFULNESS]
+
+# levels of the aggregate store
+PRODUCT_AGGREGATES = 'product'
+CATEGORY_AGGREGATES = 'category'
+REVIEWER_AGGREGATES = 'reviewer'
+YEAR_PRODUCT_AGGREGATES = 'year_product'
+MONTH_PRODUCT_AGGREGATES = 'month_product'
+AGGREGATE_LEVELS = [PRODUCT_AGGREGATES, CATEGORY_AGGREGATES, REVIEWER_AGGREGATES, YEAR_PRODUCT_AGGREGATES,
+                    MONTH_PRODUCT_AGGREGATES]
+# levels per period, sorted by time and saved with one row group per year, so that loading
+# a range of years only reads the row groups of these years
+TIME_AGGREGATE_LEVELS = [YEAR_PRODUCT_AGGREGATES, MONTH_PRODUCT_AGGREGATES]
+# keys of the periods of period_rollup
+PERIOD_KEYS = {YEAR: [YEAR], MONTH: [YEAR, MONTH]}
+# keys of the rows of every level, rows appended for new reviews are merged by key when loaded
+AGGREGATE_KEYS = {PRODUCT_AGGREGATES: [PRODUCT_ID],
+                  CATEGORY_AGGREGATES: [CATEGORY],
+                  REVIEWER_AGGREGATES: [REVIEWER_ID, REVIEWER_NAME],
+                  YEAR_PRODUCT_AGGREGATES: [YEAR, PRODUCT_ID],
+                  MONTH_PRODUCT_AGGREGATES: [YEAR, MONTH, PRODUCT_ID]}
+# columns of product aggregates taken from the product data, the same in every row of a product
+PRODUCT_ATTRIBUTE_COLUMNS = [PRICE, CATEGORY]
+
+# columns of the preprocessed data needed to build the aggregate store
+AGGREGATE_REVIEW_COLUMNS = [PRODUCT_ID, REVIEWER_ID, REVIEWER_NAME, YEAR, MONTH] + AGGREGATE_METRICS
+AGGREGATE_METADATA_COLUMNS = [PRODUCT_ID, PRICE, CATEGORY]
+
+
+def _partial_sums(df, metrics):
+    """
+    Mergeable partial aggregates of each metric, missing values are not counted
+    - {metric}_count : # of values
+    - {metric}_sum : sum of values
+    - {metric}_sumsq : sum of squared values
+    """
+    partial_sums_df = pd.DataFrame(index=df.index)
+    for metric in metrics:
+        values = df[metric].astype(float)
+        partial_sums_df[f'{metric}_count'] = values.notna().astype(np.int64)
+        partial_sums_df[f'{metric}_sum'] = values.fillna(0)
+        partial_sums_df[f'{metric}_sumsq'] = values.fillna(0) ** 2
+    return partial_sums_df
+
+
+def aggregate_mean(aggregates_df, metric):
+    """
+    Mean of a metric from its partial aggregates
+    """
+    return aggregates_df[f'{metric}_sum'] / aggregates_df[f'{metric}_count']
+
+
+def aggregate_std(aggregates_df, metric):
+    """
+    (Population) standard deviation of a metric from its partial aggregates
+    """
+    mean = aggregate_mean(aggregates_df, metric)
+    variance = aggregates_df[f'{metric}_sumsq'] / aggregates_df[f'{metric}_count'] - mean ** 2
+    return np.sqrt(variance.clip(lower=0))
+
+
+def bootstrap_aggregate_mean(aggregates_df, metric, by, num_bootstrap, confidence=0.95, random_state=None):
+    """
+    Percentile bootstrap confidence interval of the mean of a metric per group, from partial
+    aggregates, e.g. of per-product aggregates per category
+    - rows (e.g. products, with all their reviews) are resampled within each group with Poisson(1) weights
+    - the mean of each resample is the ratio of the weighted sums to the weighted counts
+    Returns a dataframe indexed by group with columns {metric}_ci_low and {metric}_ci_high
+    """
+    rng = np.random.default_rng(random_state)
+    alpha = (1 - confidence) / 2
+    intervals = {}
+    for group, group_df in aggregates_df.groupby(by, observed=True):
+        sums, counts = group_df[f'{metric}_sum'].to_numpy(), group_df[f'{metric}_count'].to_numpy()
+        # resamples are drawn in batches of about 10M weights
+        batch_size = max(1, 10 ** 7 // len(sums))
+        means = []
+        for start in range(0, num_bootstrap, batch_size):
+            weights = rng.poisson(1.0, size=(min(batch_size, num_bootstrap - start), len(sums)))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                means.append((weights @ sums) / (weights @ counts))
+        intervals[group] = np.nanquantile(np.concatenate(means), [alpha, 1 - alpha])
+    return pd.DataFrame.from_dict(intervals, orient='index', columns=[f'{metric}_ci_low', f'{metric}_ci_high'])
+
+
+def _month_product_aggregates(review_df):
+    """
+    Per (year, month, product) partial aggregates of the metrics and # of reviews
+    """
+    partial_sums_df = _partial_sums(review_df, AGGREGATE_METRICS)
+    partial_sums_df[NUM_REVIEWS] = 1
+    partial_sums_df[[YEAR, MONTH, PRODUCT_ID]] = review_df[[YEAR, MONTH, PRODUCT_ID]]
+    # observed=True groupbys keep groups in order of appearance, groups are sorted explicitly
+    return partial_sums_df.groupby([YEAR, MONTH, PRODUCT_ID], observed=True).sum().sort_index()
+
+
+def _year_product_aggregates(month_product_df):
+    """
+    Merge (year, month, product) aggregates over the months of every year
+    """
+    return month_product_df.groupby(level=[YEAR, PRODUCT_ID], observed=True).sum().sort_index()
+
+
+def period_rollup(month_product_df, period=YEAR, by=PRODUCT_ID):
+    """
+    Merge (year, month, product) aggregates (as saved in the aggregate store) into aggregates per period
+    (YEAR or MONTH) and product, or per period over all products with by=None. Aggregates already
+    rolled up over products (by=None) can be rolled up again to coarser periods
+    """
+    keys = PERIOD_KEYS[period] + ([by] if by is not None else [])
+    dropped = [column for column in PERIOD_KEYS[MONTH] + [PRODUCT_ID] if column not in keys]
+    return month_product_df.drop(columns=dropped, errors='ignore').groupby(keys, observed=True).sum().sort_index().reset_index()
+
+
+def _product_aggregates(year_product_df, review_metadata_df, product_index):
+    """
+    Merge (year, product) aggregates over years, then add price and category of each product
+    """
+    product_df = year_product_df.groupby(level=PRODUCT_ID, observed=True).sum()
+    rows = product_rows(product_df.index, product_index)
+    return product_df.join(take_product_columns(review_metadata_df, rows, [PRICE, CATEGORY], index=product_df.index))
+
+
+def _category_aggregates(product_df):
+    """
+    Merge product aggregates per category
+    - # of products -> # of products with at least one review in the category
+    """
+    category_df = product_df.drop(columns=[PRICE]).groupby(CATEGORY, observed=True).sum()
+    category_df[f'{PRODUCT_ID}_nunique'] = product_df.groupby(CATEGORY, observed=True).size()
+    return category_df
+
+
+def sorted_categories(values):
+    """
+    Categorical with categories in sorted order, so that groupbys are ordered by value
+    rather than by order of first appearance
+    """
+    values = values.astype('category')
+    return values.cat.reorder_categories(values.cat.categories.sort_values())
+
+
+def _reviewer_aggregates(review_df, review_metadata_df, product_index):
+    """
+    Per reviewer partial aggregates of the price of reviewed products and # of reviews
+    """
+    rows = product_rows(review_df[PRODUCT_ID], product_index)
+    price_df = _partial_sums(take_product_columns(review_metadata_df, rows, [PRICE], index=review_df.index), [PRICE])
+    price_df[NUM_REVIEWS] = 1
+    price_df[REVIEWER_ID] = sorted_categories(review_df[REVIEWER_ID])
+    price_df[REVIEWER_NAME] = sorted_categories(review_df[REVIEWER_NAME])
+    return price_df.groupby([REVIEWER_ID, REVIEWER_NAME], observed=True).sum().sort_index()
+
+
+def build_aggregate_store(review_df, review_metadata_df, product_index=None):
+    """
+    Aggregate review data once into partial sums and counts at the levels used by the analyses
+    - per (year, month, product) : metrics
+    - per (year, product) : metrics
+    - per product : metrics, price and category
+    - per category : metrics and # of products
+    - per reviewer : # of reviews and price
+    Only per (year, month, product) and per reviewer aggregates scan the review table,
+    coarser levels are merged from finer ones. Price and category are taken from the product data
+    rows given by product_index, which is built from review_metadata_df if not given
+    """
+    if product_index is None:
+        product_index = build_product_index(review_metadata_df[PRODUCT_ID])
+    share_categories(review_df, review_metadata_df)
+    month_product_df = _month_product_aggregates(review_df)
+    year_product_df = _year_product_aggregates(month_product_df)
+    product_df = _product_aggregates(year_product_df, review_metadata_df, product_index)
+
+    return {PRODUCT_AGGREGATES: product_df.reset_index(),
+            CATEGORY_AGGREGATES: _category_aggregates(product_df).reset_index(),
+            REVIEWER_AGGREGATES: _reviewer_aggregates(review_df, review_metadata_df, product_index).reset_index(),
+            YEAR_PRODUCT_AGGREGATES: year_product_df.reset_index(),
+            MONTH_PRODUCT_AGGREGATES: month_product_df.reset_index()}
+
+
+def append_aggregate_store(cache_dir, review_df, review_metadata_df, product_index, source_files, appended_files):
+    """
+    Add the aggregates of new reviews to the cached aggregate store, only the new reviews are scanned
+    - aggregates of the new reviews per (year, month, product), (year, product), product and reviewer
+      are appended to these levels as new parts (see append_cache) without rewriting earlier rows,
+      rows of the same keys are merged when loaded (see load_aggregates)
+    - the category level has one row per category and is rewritten, products are only counted in
+      a category if they had no review yet, using the product IDs of the product level
+    source_files are the raw data files the store was built from, appended_files the files the new
+    reviews were read from
+    """
+    new_store = build_aggregate_store(review_df, review_metadata_df, product_index=product_index)
+    product_df = new_store[PRODUCT_AGGREGATES]
+    known_products = load_cache(cache_dir, f'aggregates_{PRODUCT_AGGREGATES}', columns=[PRODUCT_ID])[PRODUCT_ID]
+    new_products = ~product_df[PRODUCT_ID].astype(str).isin(known_products.astype(str))
+
+    category_df = _category_aggregates(product_df.set_index(PRODUCT_ID))
+    category_df[f'{PRODUCT_ID}_nunique'] = product_df[new_products].groupby(CATEGORY, observed=True).size() \
+        .reindex(category_df.index, fill_value=0)
+    category_df = pd.concat([load_aggregates(cache_dir, CATEGORY_AGGREGATES), category_df.reset_index()])
+    save_cache(cache_dir, f'aggregates_{CATEGORY_AGGREGATES}', [_merge_aggregates(category_df, CATEGORY_AGGREGATES)],
+               source_files)
+
+    for level in AGGREGATE_LEVELS:
+        if level != CATEGORY_AGGREGATES:
+            append_cache(cache_dir, f'aggregates_{level}', new_store[level], appended_files)
+
+
+def is_aggregate_store_valid(cache_dir, source_files):
+    """
+    Check that every level of the aggregate store is cached and up to date
+    """
+    return all(is_cache_valid(cache_dir, f'aggregates_{level}', source_files) for level in AGGREGATE_LEVELS)
+
+
+def _year_partitions(aggregates_df):
+    """
+    Split aggregates sorted by year into one dataframe per year, all keep the same categories
+    """
+    years = aggregates_df[YEAR].to_numpy()
+    bounds = np.concatenate([[0], np.flatnonzero(years[1:] != years[:-1]) + 1, [len(years)]])
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        yield aggregates_df.iloc[start:end]
+
+
+def save_aggregate_store(cache_dir, aggregate_store, source_files):
+    """
+    Save every level of the aggregate store to the cache, levels per period with one row group per year.
+    Parts appended for new reviews are dropped, the store is built from every review of the cache
+    """
+    for level in AGGREGATE_LEVELS:
+        chunks = [aggregate_store[level]]
+        if level in TIME_AGGREGATE_LEVELS and not aggregate_store[level].empty:
+            chunks = _year_partitions(aggregate_store[level])
+        name = f'aggregates_{level}'
+        save_cache(cache_dir, name, chunks, source_files, appended_sources=appended_source_files(cache_dir, name))
+
+
+def _merge_aggregates(aggregates_df, level):
+    """
+    Merge rows of a level with the same keys by adding their partial sums and counts
+    """
+    keys = AGGREGATE_KEYS[level]
+    functions = {column: 'first' if column in PRODUCT_ATTRIBUTE_COLUMNS else 'sum'
+                 for column in aggregates_df.columns if column not in keys}
+    return aggregates_df.groupby(keys, observed=True).agg(functions).sort_index().reset_index()
+
+
+def load_aggregates(cache_dir, level, columns=None, years=None):
+    """
+    Load one level of the aggregate store from the cache. For levels per period, years=(first, last)
+    only loads the aggregates of these years, only their row groups are read
+    """
+    filters = None
+    if years is not None and level in TIME_AGGREGATE_LEVELS:
+        filters = [(YEAR, '>=', years[0]), (YEAR, '<=', years[1])]
+    name = f'aggregates_{level}'
+    if len(cache_files(cache_dir, name)) == 1:
+        return load_cache(cache_dir, name, columns=columns, filters=filters)
+    # rows appended for new reviews are merged with earlier rows of the same keys
+    if columns is None:
+        return _merge_aggregates(load_cache(cache_dir, name, filters=filters), level)
+    keys = [key for key in AGGREGATE_KEYS[level] if key not in columns]
+    return _merge_aggregates(load_cache(cache_dir, name, columns=keys + columns, filters=filters), level)[columns]
+
+
+def load_aggregate_store(cache_dir):
+    """
+    Load every level of the aggregate store from the cache
+    """
+    return {level: load_aggregates(cache_dir, level) for level in AGGREGATE_LEVELS}
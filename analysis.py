@@ -1,7 +1,15 @@
+import numpy as np
 import seaborn as sns
 from matplotlib import pyplot as plt
+from matplotlib.colors import LogNorm
 from load_data import *
 
+# confidence level of bootstrap confidence intervals
+CONFIDENCE_LEVEL = 0.95
+# maximum number of bins per axis of binned plots when the number of bins is chosen from the data
+MAX_BINS = 200
+BIN_COUNT = 'count'
+
 def get_label(column):
     """
     Get display label for visualisation of some dataframe column name
@@ -44,13 +52,128 @@ def plot_histogram(filename, df, column, title=None, log=False, max_samples=None
         plt.close()
 
 
-def print_correlation(df, x, y, x_name, y_name):
+def bar_plot(filename, df, x, y, yerr=None, capsize=8, xticks_rotation=None):
+    """
+    Plot bars from precomputed values (e.g. aggregated means), one bar per row in the given order,
+    with optional error bars from another column and optionally save the plot
+    """
+    ax = sns.barplot(x=x, y=y, data=df, order=df[x].tolist(), ci=None)
+    if yerr is not None:
+        ax.errorbar(range(len(df.index)), df[y], yerr=df[yerr], fmt='none', ecolor='.26', capsize=capsize)
+
+    plt.xlabel(get_label(x))
+    plt.ylabel(get_label(y))
+    if xticks_rotation is not None:
+        plt.xticks(rotation=xticks_rotation)
+
+    if filename is not None:
+        plt.savefig(filename, bbox_inches='tight')
+        plt.close()
+
+
+def scatter_plot(filename, df, x, y, hue=None, xlabel=None, ylabel=None, legend_loc=None):
+    """
+    Plot scatterplot from a dataframe column pair, optionally coloured by a third column,
+    and optionally save the plot
+    """
+    sns.scatterplot(x=x, y=y, data=df, hue=hue)
+    plt.xlabel(xlabel if xlabel is not None else get_label(x))
+    plt.ylabel(ylabel if ylabel is not None else get_label(y))
+    if legend_loc is not None:
+        plt.legend(loc=legend_loc)
+
+    if filename is not None:
+        plt.savefig(filename, bbox_inches='tight')
+        plt.close()
+
+
+def line_plot(filename, df, x, y, xlabel=None, ylabel=None):
+    """
+    Plot a line through precomputed values (e.g. aggregated means per period) in the given order
+    and optionally save the plot
+    """
+    plt.plot(df[x], df[y], marker='.')
+    plt.xlabel(xlabel if xlabel is not None else get_label(x))
+    plt.ylabel(ylabel if ylabel is not None else get_label(y))
+    plt.xticks(rotation=45)
+
+    if filename is not None:
+        plt.savefig(filename, bbox_inches='tight')
+        plt.close()
+
+
+def reg_plot(filename, df, x, y, max_samples=None, alpha=0.4):
+    """
+    Plot scatterplot with linear regression fit from a dataframe column pair and optionally save the plot
+    """
+    if max_samples is not None:
+        df = df.sample(min(len(df.index), max_samples))
+
+    sns.regplot(data=df, x=x, y=y, marker='+', scatter_kws={'alpha': alpha})
+    plt.xlabel(get_label(x))
+    plt.ylabel(get_label(y))
+
+    if filename is not None:
+        plt.savefig(filename, bbox_inches='tight')
+        plt.close()
+
+
+def facet_plot(filename, df, x, y, col, kind='scatter', alpha=0.3, xlim=None, ylim=None):
+    """
+    Plot one scatterplot (kind='scatter') or regression plot (kind='reg') per value of a
+    dataframe column and optionally save the plot
+    """
+    g = sns.FacetGrid(df, col=col, height=5, col_wrap=2)
+    if kind == 'reg':
+        g.map(sns.regplot, x, y, marker='+', scatter_kws={'alpha': alpha})
+    else:
+        g.map(sns.scatterplot, x, y, marker='+', alpha=alpha)
+    g.set_axis_labels(get_label(x), get_label(y))
+
+    if xlim is not None:
+        plt.xlim(xlim)
+    if ylim is not None:
+        plt.ylim(ylim)
+
+    if filename is not None:
+        plt.savefig(filename, bbox_inches='tight')
+        plt.close()
+
+
+def bootstrap_correlation(x, y, num_bootstrap, confidence=CONFIDENCE_LEVEL, random_state=None):
+    """
+    Percentile bootstrap confidence interval of the Pearson correlation of 2 arrays,
+    pairs with a missing value are ignored
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    valid = ~np.isnan(x) & ~np.isnan(y)
+    x, y = x[valid], y[valid]
+
+    rng = np.random.default_rng(random_state)
+    correlations = np.empty(num_bootstrap)
+    for i in range(num_bootstrap):
+        sample = rng.integers(0, len(x), size=len(x))
+        correlations[i] = np.corrcoef(x[sample], y[sample])[0, 1]
+    alpha = (1 - confidence) / 2
+    return np.nanquantile(correlations, [alpha, 1 - alpha])
+
+
+def print_correlation(df, x, y, x_name, y_name, num_bootstrap=None, correlation=None):
     """
-    Print correlation between 2 columns of a dataframe
+    Print correlation between 2 columns of a dataframe, with a bootstrap
+    confidence interval from num_bootstrap resamples if given. A precomputed
+    correlation (e.g. from streaming moments) is printed instead of rescanning the dataframe
     """
-    df = df[df[x].notna() & df[x].notna()]
-    correlation = round(100 * df[x].corr(df[y]), 1)
-    print(f"Correlation between {x_name} and {y_name} = {correlation}%")
+    if correlation is None:
+        df = df[df[x].notna() & df[y].notna()]
+        correlation = df[x].corr(df[y])
+    correlation = round(100 * correlation, 1)
+    if num_bootstrap is None:
+        print(f"Correlation between {x_name} and {y_name} = {correlation}%")
+        return
+    low, high = np.round(100 * bootstrap_correlation(df[x], df[y], num_bootstrap), 1)
+    print(f"Correlation between {x_name} and {y_name} = {correlation}% "
+          f"({100 * CONFIDENCE_LEVEL:g}% CI {low}% to {high}%)")
 
 
 def joint_plot(filename, df, x, y, max_samples=None, alpha=0.5, xlim=None, ylim=None):
@@ -84,3 +207,104 @@ def joint_plot(filename, df, x, y, max_samples=None, alpha=0.5, xlim=None, ylim=
     if filename is not None:
         plt.savefig(filename, bbox_inches='tight')
         plt.close()
+
+
+def _bin_edges(values, bins):
+    """
+    Bin edges of an array of values, with the number of bins or the numpy rule used to choose it
+    (capped to MAX_BINS). Integer values spanning fewer values than bins get one bin per integer
+    """
+    edges = np.histogram_bin_edges(values, bins=bins)
+    if isinstance(bins, str) and len(edges) - 1 > MAX_BINS:
+        edges = np.histogram_bin_edges(values, bins=MAX_BINS)
+    if len(values) > 0 and values.max() - values.min() < len(edges) - 1 and np.all(values == np.round(values)):
+        edges = np.arange(values.min() - 0.5, values.max() + 1)
+    return edges
+
+
+def _interval_edges(intervals):
+    """
+    Bin edges of an IntervalIndex of contiguous bins
+    """
+    return np.append(intervals.left, intervals.right[-1])
+
+
+def histogram_bins(values, bins='auto'):
+    """
+    Histogram of all non-missing values of a column, computed with numpy
+    -> dataframe indexed by bin intervals with the number of values in each bin.
+    Counts of chunks binned with the same explicit bin edges can be added together
+    """
+    name = getattr(values, 'name', None)
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    counts, edges = np.histogram(values, bins=_bin_edges(values, bins))
+    return pd.DataFrame({BIN_COUNT: counts}, index=pd.IntervalIndex.from_breaks(edges, name=name))
+
+
+def density_bins(x, y, bins=50):
+    """
+    2-D histogram of all pairs of non-missing values of 2 columns, computed with numpy
+    -> dataframe of counts indexed by x bin intervals, with y bin intervals as columns
+    """
+    x_values, y_values = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    valid = ~np.isnan(x_values) & ~np.isnan(y_values)
+    x_values, y_values = x_values[valid], y_values[valid]
+    counts, x_edges, y_edges = np.histogram2d(x_values, y_values,
+                                              bins=[_bin_edges(x_values, bins), _bin_edges(y_values, bins)])
+    return pd.DataFrame(counts.astype(np.int64),
+                        index=pd.IntervalIndex.from_breaks(x_edges, name=x.name),
+                        columns=pd.IntervalIndex.from_breaks(y_edges, name=y.name))
+
+
+def plot_binned_histogram(filename, histogram_df, title=None, log=False, fill=False):
+    """
+    Plot histogram from precomputed bins (see histogram_bins) and optionally save the plot.
+    Rendering cost depends on the number of bins only, not on the number of values
+    """
+    bins = histogram_df.index
+    plt.hist(bins.mid, bins=_interval_edges(bins), weights=histogram_df[BIN_COUNT],
+             histtype='stepfilled' if fill else 'step', color=sns.color_palette()[0])
+    if log:
+        plt.yscale("log")
+
+    xlabel = get_label(bins.name)
+    plt.xlabel(xlabel)
+    plt.ylabel('Count')
+
+    if title is not None:
+        plt.title(title)
+    else:
+        plt.title(f'Distribution : {xlabel}')
+
+    if filename is not None:
+        plt.savefig(filename, bbox_inches='tight')
+        plt.close()
+
+
+def binned_joint_plot(filename, density_df, xlim=None, ylim=None):
+    """
+    Plot 2-D density (log scaled counts) from precomputed bins (see density_bins) with marginal
+    histograms and optionally save the plot. Rendering cost depends on the number of bins only
+    """
+    x_bins, y_bins = density_df.index, density_df.columns
+    x_edges, y_edges = _interval_edges(x_bins), _interval_edges(y_bins)
+    counts = density_df.to_numpy()
+
+    g = sns.JointGrid()
+    g.ax_joint.pcolormesh(x_edges, y_edges, np.ma.masked_equal(counts.T, 0),
+                          cmap=sns.light_palette(sns.color_palette()[0], as_cmap=True), norm=LogNorm())
+    g.ax_marg_x.hist(x_bins.mid, bins=x_edges, weights=counts.sum(axis=1), histtype='stepfilled', alpha=0.5)
+    g.ax_marg_y.hist(y_bins.mid, bins=y_edges, weights=counts.sum(axis=0), histtype='stepfilled', alpha=0.5,
+                     orientation='horizontal')
+
+    g.set_axis_labels(get_label(x_bins.name), get_label(y_bins.name))
+
+    if xlim is not None:
+        plt.xlim(xlim)
+    if ylim is not None:
+        plt.ylim(ylim)
+
+    if filename is not None:
+        plt.savefig(filename, bbox_inches='tight')
+        plt.close()
@@ -0,0 +1,157 @@
+import argparse
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from tabulate import tabulate
+
+import load_data
+from load_data import *
+from load_data import _load_data, _load_metadata, \
+    _process_helpfulness, _process_salesrank, _process_related_products, \
+    _process_helpfulness_column, _process_salesrank_column, _process_related_products_column
+from aggregates import *
+from generate_data import generate_data, generate_reviews, generate_products
+from main import review_behavior_by_category, get_average_metric_with_price, sample_products_bought_together
+from profiling import *
+
+PIPELINE_REPORT_COLUMNS = ['stage', 'rows', 'wall_time', 'cpu_time', 'rows_per_s', 'process_peak_rss_mb']
+
+
+def _normalise(result):
+    """
+    String representation of parser output with all missing values represented as None
+    """
+    return result.astype(object).where(result.notna(), None).astype(str)
+
+
+def _time(func, *args):
+    """
+    Run func and return its result together with the elapsed wall time in seconds
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def benchmark_parsers(num_rows, seed=0):
+    """
+    Compare the per-row (ast.literal_eval + DataFrame.apply) parsers with the vectorized parsers
+    on synthetic raw fields, including the edge cases handled by the parsers
+    - check that both produce the same output
+    - print time taken and speedup
+    """
+    rng = np.random.default_rng(seed)
+    reviews_df = generate_reviews(rng, num_rows, max(1, num_rows // 10))
+    helpfulness, review_text = reviews_df[HELPFULNESS], reviews_df[REVIEW_TEXT]
+    products_df = generate_products(rng, num_rows)
+    salesrank, related = products_df[SALES_RANK], products_df[RELATED_PRODUCTS]
+    # read_csv converters receive missing values as empty strings
+    related_converter_input = related.fillna('')
+
+    benchmarks = [('helpfulness',
+                   lambda: helpfulness.apply(_process_helpfulness).astype(float),
+                   lambda: _process_helpfulness_column(helpfulness)),
+                  ('salesrank',
+                   lambda: salesrank.apply(_process_salesrank).astype({SALES_RANK: float}),
+                   lambda: _process_salesrank_column(salesrank)),
+                  ('related products',
+                   lambda: related_converter_input.apply(_process_related_products),
+                   lambda: _process_related_products_column(related)),
+                  ('review word count',
+                   lambda: review_text.fillna('').map(lambda text: len(text.split())),
+                   lambda: pd.Series(text_statistics(*encode_texts(review_text), statistics=[NUM_WORDS])[NUM_WORDS],
+                                     index=review_text.index))]
+
+    for name, per_row_func, vectorized_func in benchmarks:
+        per_row_result, per_row_time = _time(per_row_func)
+        vectorized_result, vectorized_time = _time(vectorized_func)
+        assert _normalise(per_row_result).equals(_normalise(vectorized_result)), name
+        print(f'{name:>20}: per-row {per_row_time:.3f}s, vectorized {vectorized_time:.3f}s, '
+              f'speedup {per_row_time / vectorized_time:.1f}x')
+
+
+def benchmark_pipeline(data_dir, load_all_data=False, num_samples=10000):
+    """
+    Time the stages of the analysis pipeline on the raw data files in data_dir
+    - loading and processing review and product data
+    - building the aggregate store, saving it to a temporary cache folder and loading it back,
+      as main.py does instead of joining reviews with products
+    - the per-category, per-product and bought together analyses on the loaded aggregates
+    Returns one record per top level stage with throughput (rows/s) and the peak memory of the process so far
+    """
+    load_data.DATA_DIR = data_dir
+    enable_profiling()
+    pop_profile_records()
+
+    with profile_stage('load_data') as stage:
+        review_df = concat_processed([_load_data(category)
+                                      for category in (REVIEW_FILES if load_all_data else ['clothing'])])
+        stage['rows'] = len(review_df.index)
+    with profile_stage('load_metadata') as stage:
+        review_metadata_df = _load_metadata('all' if load_all_data else 'clothing')
+        stage['rows'] = len(review_metadata_df.index)
+
+    with profile_stage('build_aggregate_store') as stage:
+        aggregate_store = build_aggregate_store(review_df, review_metadata_df)
+        stage['rows'] = len(review_df.index)
+    review_files, metadata_files = review_data_files(load_all_data=load_all_data)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        with profile_stage('save_aggregate_store') as stage:
+            save_aggregate_store(cache_dir, aggregate_store, review_files + metadata_files)
+            stage['rows'] = sum(len(aggregates_df.index) for aggregates_df in aggregate_store.values())
+        with profile_stage('load_aggregate_store') as stage:
+            aggregate_store = load_aggregate_store(cache_dir)
+            stage['rows'] = sum(len(aggregates_df.index) for aggregates_df in aggregate_store.values())
+
+    with profile_stage('review_behavior_by_category') as stage:
+        review_behavior_by_category(aggregate_store[CATEGORY_AGGREGATES], RATING)
+        stage['rows'] = len(aggregate_store[CATEGORY_AGGREGATES].index)
+    with profile_stage('get_average_metric_with_price') as stage:
+        get_average_metric_with_price(aggregate_store[PRODUCT_AGGREGATES], RATING)
+        stage['rows'] = len(aggregate_store[PRODUCT_AGGREGATES].index)
+    with profile_stage('sample_products_bought_together') as stage:
+        sample_products_bought_together(aggregate_store[PRODUCT_AGGREGATES], review_metadata_df,
+                                        num_samples=num_samples)
+        stage['rows'] = num_samples
+
+    # parser stages are nested in the load stages
+    records = [record for record in pop_profile_records() if record['parent'] is None]
+    for record in records:
+        record['rows_per_s'] = record['rows'] / record['wall_time'] if record['wall_time'] > 0 else None
+    return records
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', type=str, nargs='?', default='parsers', choices=['parsers', 'pipeline'],
+                        help='Benchmark the raw field parsers or the analysis pipeline')
+    parser.add_argument('--num_rows', type=int, nargs='?', default=100000,
+                        help='Number of synthetic rows to parse, or reviews to generate for the pipeline')
+    parser.add_argument('--data_dir', type=str, nargs='?', default=None,
+                        help='Run the pipeline on existing raw data instead of generating synthetic data')
+    parser.add_argument('--load_all_data', action='store_true',
+                        help='Run the pipeline on all review categories instead of clothing only')
+    parser.add_argument('--num_samples', type=int, nargs='?', default=10000,
+                        help='Number of bought together pairs to sample')
+    parser.add_argument('--report', type=str, nargs='?', default=None,
+                        help='Save pipeline results to this CSV file')
+    parser.add_argument('--seed', type=int, nargs='?', default=0,
+                        help='Random seed for synthetic data')
+    args = parser.parse_args()
+
+    if args.benchmark == 'parsers':
+        benchmark_parsers(args.num_rows, seed=args.seed)
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data_dir = args.data_dir
+            if data_dir is None:
+                data_dir = tmp_dir
+                generate_data(data_dir, args.num_rows, load_all_data=args.load_all_data, seed=args.seed)
+            report_df = pd.DataFrame(benchmark_pipeline(data_dir, load_all_data=args.load_all_data,
+                                                        num_samples=args.num_samples),
+                                     columns=PIPELINE_REPORT_COLUMNS)
+
+        print(tabulate(report_df, headers='keys', tablefmt='psql', showindex=False, floatfmt='.2f'))
+        if args.report is not None:
+            report_df.to_csv(args.report, index=False)
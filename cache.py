@@ -0,0 +1,182 @@
+import glob
+import json
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from load_data import *
+from profiling import profile_stage
+
+CACHE_DIR_NAME = 'cache'
+REVIEW_CACHE = 'review_df'
+METADATA_CACHE = 'review_metadata_df'
+
+# column types of the preprocessed data, columns not listed here are inferred from the data.
+# These match the compact in-memory types of load_data (COMPACT_DTYPES)
+# - IDs, names and categories are dictionary encoded (categoricals in pandas)
+# - lists of products bought together are stored as list columns
+CACHE_SCHEMA = {
+    REVIEWER_ID: pa.dictionary(pa.int32(), pa.string()),
+    PRODUCT_ID: pa.dictionary(pa.int32(), pa.string()),
+    REVIEWER_NAME: pa.dictionary(pa.int32(), pa.string()),
+    CATEGORY: pa.dictionary(pa.int32(), pa.string()),
+    BRAND: pa.dictionary(pa.int32(), pa.string()),
+    PRODUCT_TITLE: pa.string(),
+    RATING: pa.int8(),
+    UNIX_REVIEW_TIME: pa.int32(),
+    REVIEW_WORD_COUNT: pa.int32(),
+    REVIEW_CHARACTER_COUNT: pa.int32(),
+    REVIEW_SENTENCE_COUNT: pa.int32(),
+    SUMMARY_LENGTH: pa.int32(),
+    SUMMARY_CHARACTER_COUNT: pa.int32(),
+    PRODUCT_DESCRIPTION_LENGTH: pa.int32(),
+    YEAR: pa.int16(),
+    MONTH: pa.int8(),
+    HELPFULNESS: pa.float32(),
+    NUM_HELPFUL: pa.float32(),
+    NUM_UNHELPFUL: pa.float32(),
+    SALES_RANK: pa.float64(),
+    PRICE: pa.float64(),
+    BOUGHT_TOGETHER: pa.list_(pa.string())
+}
+
+# saved with the fingerprint of every cache entry, entries written with another version are rebuilt
+CACHE_VERSION = 5
+
+
+def _cache_paths(cache_dir, name):
+    """
+    Paths of the data file and the source fingerprint file of a cache entry
+    """
+    return os.path.join(cache_dir, f'{name}.parquet'), os.path.join(cache_dir, f'{name}.json')
+
+
+def cache_files(cache_dir, name):
+    """
+    Paths of all data files of a cache entry, the full build followed by appended parts
+    """
+    data_path, _ = _cache_paths(cache_dir, name)
+    return [data_path] + sorted(glob.glob(os.path.join(cache_dir, f'{name}.part*.parquet')))
+
+
+def appended_source_files(cache_dir, name):
+    """
+    Paths of the files the appended parts of a cache entry were read from, in the order they were
+    appended. A part appended without a record of its files is reported by its own path
+    """
+    source_files = []
+    for part_path in cache_files(cache_dir, name)[1:]:
+        sources_path = f'{part_path}.sources.json'
+        if not os.path.exists(sources_path):
+            source_files.append(part_path)
+            continue
+        with open(sources_path) as f:
+            source_files.extend(json.load(f))
+    return source_files
+
+
+def _fingerprint(source_files):
+    """
+    Identify raw data files by path, size and modification time, and the cache format by its version
+    """
+    files = []
+    for filename in source_files:
+        stat = os.stat(filename)
+        files.append({'path': os.path.abspath(filename),
+                      'size': stat.st_size,
+                      'mtime': stat.st_mtime})
+    return {'version': CACHE_VERSION, 'files': files}
+
+
+def _to_table(df):
+    """
+    Convert a dataframe to an arrow table using the cache column types
+    """
+    schema = pa.Table.from_pandas(df.iloc[:0], preserve_index=False).schema
+    for i, field in enumerate(schema):
+        if field.name in CACHE_SCHEMA:
+            schema = schema.set(i, pa.field(field.name, CACHE_SCHEMA[field.name]))
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+
+def is_cache_valid(cache_dir, name, source_files):
+    """
+    Check that a cache entry exists and was built from the current version of the raw data files
+    """
+    data_path, fingerprint_path = _cache_paths(cache_dir, name)
+    if not os.path.exists(data_path) or not os.path.exists(fingerprint_path):
+        return False
+    try:
+        current_fingerprint = _fingerprint(source_files)
+    except FileNotFoundError:
+        return False
+    with open(fingerprint_path) as f:
+        return json.load(f) == current_fingerprint
+
+
+def save_cache(cache_dir, name, chunks, source_files, appended_sources=()):
+    """
+    Write preprocessed dataframe(s) to a columnar (parquet) cache entry
+    - chunks is an iterable of dataframes, written one row group at a time
+    - the fingerprint of the raw data files is saved alongside and is only
+      written once all the data has been written
+    - parts appended to the previous entry (see append_cache) are dropped only if the files they
+      were read from are given as appended_sources, otherwise a ValueError is raised
+    Returns the number of rows written
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    data_path, fingerprint_path = _cache_paths(cache_dir, name)
+    appended_sources = {os.path.abspath(filename) for filename in appended_sources}
+    dropped = [filename for filename in appended_source_files(cache_dir, name) if filename not in appended_sources]
+    if dropped:
+        raise ValueError(f'rebuilding {name} would drop the rows appended from {", ".join(dropped)}')
+    # a full build replaces the previous entry, including appended parts and their side files
+    for filename in glob.glob(os.path.join(cache_dir, f'{name}.*')):
+        os.remove(filename)
+
+    num_rows = 0
+    writer = None
+    with profile_stage(f'save_cache:{name}') as stage:
+        for df in chunks:
+            table = _to_table(df)
+            if writer is None:
+                writer = pq.ParquetWriter(data_path, table.schema)
+            writer.write_table(table.cast(writer.schema))
+            num_rows += table.num_rows
+        if writer is not None:
+            writer.close()
+        stage['rows'] = num_rows
+
+    with open(fingerprint_path, 'w') as f:
+        json.dump(_fingerprint(source_files), f)
+    return num_rows
+
+
+def append_cache(cache_dir, name, df, source_files):
+    """
+    Append rows read from source_files to an existing cache entry as a new part, without rewriting
+    existing data. The fingerprint of the entry is left unchanged, the source files of the part
+    are saved alongside it (see appended_source_files). Returns the path of the new part
+    """
+    parts = cache_files(cache_dir, name)
+    part_path = os.path.join(cache_dir, f'{name}.part{len(parts):04d}.parquet')
+    schema = pq.read_schema(parts[0])
+    pq.write_table(_to_table(df[schema.names]).cast(schema), part_path)
+    with open(f'{part_path}.sources.json', 'w') as f:
+        json.dump([os.path.abspath(filename) for filename in source_files], f)
+    return part_path
+
+
+def load_cache(cache_dir, name, columns=None, filters=None):
+    """
+    Load a cache entry (including appended parts) into a pandas dataframe,
+    optionally only a subset of the columns and the rows matching filters (in the pyarrow format,
+    e.g. [('year', '>=', 2010)]). Row groups whose statistics do not match filters are not read
+    """
+    with profile_stage(f'load_cache:{name}') as stage:
+        tables = [pq.read_table(filename, columns=columns, filters=filters)
+                  for filename in cache_files(cache_dir, name)]
+        df = pa.concat_tables(tables).to_pandas()
+        stage['rows'] = len(df.index)
+    return df
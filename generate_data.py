@@ -0,0 +1,198 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+from load_data import *
+
+# words used to build review texts, summaries and product descriptions
+WORDS = ['good', 'great', 'fit', 'size', 'quality', 'love', 'comfortable', 'small', 'large', 'color',
+         'price', 'nice', 'wear', 'shoes', 'dress', 'perfect', 'little', 'bought', 'well', 'recommend']
+MAX_WORDS = 2000
+
+# top level categories (salesRank keys) and their relative frequencies
+SALES_RANK_CATEGORIES = ['Clothing, Shoes & Jewelry', 'Shoes', 'Jewelry', 'Watches', 'Sports &amp; Outdoors',
+                         'Home &amp; Kitchen', 'Toys & Games', 'Beauty', "Kids' Fashion", 'Books']
+SALES_RANK_CATEGORY_WEIGHTS = [0.5, 0.1, 0.1, 0.05, 0.05, 0.05, 0.05, 0.04, 0.03, 0.03]
+
+# rating frequencies of 1 to 5 stars
+RATING_WEIGHTS = [0.05, 0.05, 0.1, 0.2, 0.6]
+
+# 1999-01-01 to 2014-07-23, the time range of the Amazon review data
+MIN_UNIX_REVIEW_TIME = 915148800
+MAX_UNIX_REVIEW_TIME = 1406073600
+
+# fraction of rows set to edge cases handled by the parsers
+MISSING_FRACTION = 0.01
+INVALID_HELPFULNESS_FRACTION = 0.0005
+EMPTY_SALES_RANK_FRACTION = 0.02
+MALFORMED_RELATED_FRACTION = 0.005
+
+# prefixes[n] -> text with n words
+_TEXT_PREFIXES = np.array([' '.join(WORDS[i % len(WORDS)] for i in range(n)) for n in range(MAX_WORDS + 1)],
+                          dtype=object)
+
+
+def _product_ids(product_indices):
+    """
+    Product IDs in the same format as the asin field
+    """
+    return pd.Series(product_indices).map('B{:09d}'.format)
+
+
+def _texts(rng, size, mean_words):
+    """
+    Texts with a log-normally distributed number of words
+    """
+    num_words = rng.lognormal(np.log(mean_words), 0.8, size=size).astype(int).clip(1, MAX_WORDS)
+    return _TEXT_PREFIXES[num_words]
+
+
+def _with_missing(rng, values, fraction=MISSING_FRACTION):
+    """
+    Replace a random fraction of values by missing values
+    """
+    values = pd.Series(values, dtype=object)
+    values[rng.random(len(values.index)) < fraction] = None
+    return values
+
+
+def _product_id_lists(rng, num_products, sizes):
+    """
+    String representation of lists of random Product IDs, e.g. "['B000000001', 'B000000002']"
+    """
+    product_ids = _product_ids(rng.integers(0, num_products, size=sizes.sum())).tolist()
+    ends = np.cumsum(sizes)
+    return [str(product_ids[end - size:end]) for size, end in zip(sizes, ends)]
+
+
+def generate_reviews(rng, num_reviews, num_products, num_reviewers=None):
+    """
+    Random review data with the columns and field formats of the raw review files
+    - product popularity follows a power law
+    - helpful -> [# of helpful votes, total # of votes], including some with num_helpful > total
+    """
+    if num_reviewers is None:
+        num_reviewers = max(1, num_reviews // 5)
+
+    # power law product popularity, product 0 is the most reviewed
+    products = (num_products * rng.power(0.3, size=num_reviews)).astype(np.int64).clip(0, num_products - 1)
+    reviewers = rng.integers(0, num_reviewers, size=num_reviews)
+
+    total = rng.negative_binomial(0.3, 0.2, size=num_reviews)
+    num_helpful = rng.binomial(total, 0.7)
+    invalid = rng.random(num_reviews) < INVALID_HELPFULNESS_FRACTION
+    num_helpful[invalid] = total[invalid] + 1
+    helpfulness = '[' + pd.Series(num_helpful).astype(str) + ', ' + pd.Series(total).astype(str) + ']'
+
+    unix_review_time = rng.integers(MIN_UNIX_REVIEW_TIME, MAX_UNIX_REVIEW_TIME, size=num_reviews)
+    review_date = pd.to_datetime(pd.Series(unix_review_time), unit='s')
+    # reviewTime -> '05 3, 2014'
+    review_time = review_date.dt.strftime('%m ') + review_date.dt.day.astype(str) + review_date.dt.strftime(', %Y')
+
+    reviewer_ids = pd.Series(reviewers).map('A{:013d}'.format)
+    return pd.DataFrame({REVIEWER_ID: reviewer_ids,
+                         PRODUCT_ID: _product_ids(products),
+                         REVIEWER_NAME: _with_missing(rng, 'Reviewer ' + pd.Series(reviewers).astype(str)),
+                         HELPFULNESS: helpfulness,
+                         REVIEW_TEXT: _texts(rng, num_reviews, 80),
+                         RATING: rng.choice(np.arange(1, 6), p=RATING_WEIGHTS, size=num_reviews).astype(float),
+                         SUMMARY: _texts(rng, num_reviews, 4),
+                         UNIX_REVIEW_TIME: unix_review_time,
+                         REVIEW_TIME: review_time},
+                        columns=REVIEW_COLUMNS)
+
+
+def generate_products(rng, num_products, start=0, stop=None):
+    """
+    Random product data with the columns and field formats of the raw metadata files,
+    for products start to stop out of num_products
+    - salesRank -> {'Category': rank}, including empty dicts
+    - related -> {'also_bought': [...], 'also_viewed': [...], 'bought_together': [...]},
+      bought_together only for some products, including malformed records
+    """
+    stop = num_products if stop is None else stop
+    size = stop - start
+    categories = rng.choice(SALES_RANK_CATEGORIES, p=SALES_RANK_CATEGORY_WEIGHTS, size=size)
+    sales_rank = pd.Series([str({category: rank}) for category, rank
+                            in zip(categories, rng.integers(1, 10 ** 6, size=size))])
+    sales_rank[rng.random(size) < EMPTY_SALES_RANK_FRACTION] = '{}'
+
+    also_bought = _product_id_lists(rng, num_products, rng.integers(0, 20, size=size))
+    also_viewed = _product_id_lists(rng, num_products, rng.integers(0, 10, size=size))
+    bought_together = _product_id_lists(rng, num_products, rng.integers(1, 4, size=size))
+    has_bought_together = rng.random(size) < 0.3
+    related = pd.Series([f"{{'also_bought': {bought}, 'also_viewed': {viewed}"
+                         + (f", 'bought_together': {together}}}" if has_together else '}')
+                         for bought, viewed, together, has_together
+                         in zip(also_bought, also_viewed, bought_together, has_bought_together)])
+    related[rng.random(size) < MALFORMED_RELATED_FRACTION] = "{'also_bought': ['B0"
+
+    price = pd.Series(rng.lognormal(3, 1, size=size).round(2))
+    price[rng.random(size) < 0.2] = np.nan
+
+    return pd.DataFrame({PRODUCT_ID: _product_ids(np.arange(start, stop)),
+                         SALES_RANK: _with_missing(rng, sales_rank),
+                         PRODUCT_TITLE: _texts(rng, size, 6),
+                         PRODUCT_DESCRIPTION: _with_missing(rng, _texts(rng, size, 50), fraction=0.1),
+                         PRICE: price,
+                         RELATED_PRODUCTS: _with_missing(rng, related),
+                         BRAND: _with_missing(rng, 'Brand ' + pd.Series(rng.integers(0, 1000, size=size)).astype(str),
+                                              fraction=0.5)},
+                        columns=PRODUCT_COLUMNS)
+
+
+def _write_chunks(filename, chunks):
+    """
+    Write chunks of generated data to a CSV file, writing the header only once.
+    Returns the number of rows written
+    """
+    num_rows = 0
+    for i, df in enumerate(chunks):
+        df.to_csv(filename, mode='w' if i == 0 else 'a', header=(i == 0), index=False)
+        num_rows += len(df.index)
+    return num_rows
+
+
+def generate_data(data_dir, num_reviews, num_products=None, load_all_data=False, seed=0,
+                  chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Write synthetic raw review and metadata files in the format read by load_data
+    - clothing files only, or every category in REVIEW_FILES (num_reviews each) and the
+      combined metadata file if load_all_data
+    - data is generated and written chunksize rows at a time, so any scale fits in memory
+    """
+    rng = np.random.default_rng(seed)
+    if num_products is None:
+        num_products = max(1, num_reviews // 10)
+
+    os.makedirs(data_dir, exist_ok=True)
+    categories = list(REVIEW_FILES) if load_all_data else ['clothing']
+    for category in categories:
+        _write_chunks(os.path.join(data_dir, REVIEW_FILES[category]),
+                      (generate_reviews(rng, min(chunksize, num_reviews - start), num_products)
+                       for start in range(0, num_reviews, chunksize)))
+
+    _write_chunks(os.path.join(data_dir, METADATA_FILES['all' if load_all_data else 'clothing']),
+                  (generate_products(rng, num_products, start=start, stop=min(start + chunksize, num_products))
+                   for start in range(0, num_products, chunksize)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, nargs='?', default='data',
+                        help='Data folder path')
+    parser.add_argument('--num_reviews', type=int, nargs='?', default=10000,
+                        help='Number of reviews (per category with --load_all_data)')
+    parser.add_argument('--num_products', type=int, nargs='?', default=None,
+                        help='Number of products, defaults to 1 per 10 reviews')
+    parser.add_argument('--load_all_data', action='store_true',
+                        help='Generate all review categories instead of clothing only')
+    parser.add_argument('--seed', type=int, nargs='?', default=0,
+                        help='Random seed')
+    parser.add_argument('--chunksize', type=int, nargs='?', default=DEFAULT_CHUNKSIZE,
+                        help='Number of rows generated at a time')
+    args = parser.parse_args()
+
+    generate_data(args.data_dir, args.num_reviews, num_products=args.num_products,
+                  load_all_data=args.load_all_data, seed=args.seed, chunksize=args.chunksize)
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from load_data import *
+from cache import *
+from product_index import *
+
+GRAPH_CACHE = 'bought_together_graph'
+SOURCE = 'source'
+TARGET = 'target'
+
+
+def build_bought_together_graph(review_metadata_df, product_index):
+    """
+    Co-purchase graph of the product data in CSR form, nodes are product rows (see product_index)
+    - indptr : products bought together with product row i are indices[indptr[i]:indptr[i + 1]]
+    - indices : product rows of products bought together, sorted for every product
+    Only products in the product data are kept, repeated Product IDs are merged into their first row
+    and repeated pairs are kept once
+    """
+    num_products = len(review_metadata_df.index)
+    bought_together = review_metadata_df[BOUGHT_TOGETHER]
+    lengths = bought_together.str.len().fillna(0).astype(np.int64).to_numpy()
+    sources = np.repeat(product_rows(review_metadata_df[PRODUCT_ID], product_index), lengths)
+    targets = product_rows(bought_together[lengths > 0].explode().to_numpy(), product_index)
+
+    known = (sources >= 0) & (targets >= 0)
+    # unique (source, target) pairs, in source then target order
+    pairs = np.unique(sources[known].astype(np.int64) * num_products + targets[known])
+    sources, targets = pairs // num_products, pairs % num_products
+    return {'indptr': np.append(0, np.cumsum(np.bincount(sources, minlength=num_products))),
+            'indices': targets.astype(np.int32)}
+
+
+def save_bought_together_graph(cache_dir, source_files):
+    """
+    Build the co-purchase graph of the cached product data and save it next to it,
+    as a table of (source, target) product rows sorted by source
+    """
+    graph = build_bought_together_graph(load_cache(cache_dir, METADATA_CACHE, columns=[PRODUCT_ID, BOUGHT_TOGETHER]),
+                                        load_product_index(cache_dir))
+    sources = np.repeat(np.arange(len(graph['indptr']) - 1, dtype=np.int32), np.diff(graph['indptr']))
+    save_cache(cache_dir, GRAPH_CACHE, [pd.DataFrame({SOURCE: sources, TARGET: graph['indices']})], source_files)
+    return graph
+
+
+def load_bought_together_graph(cache_dir):
+    """
+    Load the co-purchase graph of the cached product data
+    """
+    edges_df = load_cache(cache_dir, GRAPH_CACHE)
+    num_products = sum(pq.ParquetFile(filename).metadata.num_rows for filename in cache_files(cache_dir, METADATA_CACHE))
+    return {'indptr': np.append(0, np.cumsum(np.bincount(edges_df[SOURCE].to_numpy(), minlength=num_products))),
+            'indices': edges_df[TARGET].to_numpy()}
+
+
+def _edge_sources(graph):
+    """
+    Source product row of every edge of the graph
+    """
+    return np.repeat(np.arange(len(graph['indptr']) - 1), np.diff(graph['indptr']))
+
+
+def neighbor_statistics(graph, values, name):
+    """
+    Statistics of a product metric (one value per product row, missing where unknown)
+    over the products bought together with every product, in one pass over all edges
+    - NUM_BOUGHT_TOGETHER : # of products bought together
+    - {name}_count : # of products bought together with a value
+    - {name}_mean : mean value of products bought together
+    """
+    values = np.asarray(values, dtype=float)
+    sources = _edge_sources(graph)
+    neighbor_values = values[graph['indices']]
+    known = ~np.isnan(neighbor_values)
+    num_products = len(values)
+
+    count = np.bincount(sources[known], minlength=num_products)
+    total = np.bincount(sources[known], weights=neighbor_values[known], minlength=num_products)
+    return pd.DataFrame({NUM_BOUGHT_TOGETHER: np.diff(graph['indptr']),
+                         f'{name}_count': count,
+                         f'{name}_mean': np.divide(total, count, out=np.full(num_products, np.nan), where=count > 0)})
+
+
+def assortativity(graph, values):
+    """
+    Assortativity coefficient of a product metric, i.e. the correlation of the values of
+    both products of every edge where both are known. Edges are counted in both directions so that
+    the coefficient does not depend on which product lists the other. Returns the coefficient and
+    the number of edges
+    """
+    values = np.asarray(values, dtype=float)
+    source_values, target_values = values[_edge_sources(graph)], values[graph['indices']]
+    known = ~np.isnan(source_values) & ~np.isnan(target_values)
+    source_values, target_values = source_values[known], target_values[known]
+    return (np.corrcoef(np.concatenate([source_values, target_values]),
+                        np.concatenate([target_values, source_values]))[0, 1],
+            int(known.sum()))
@@ -0,0 +1,91 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from load_data import *
+from cache import *
+from aggregates import *
+from moments import *
+from text_store import *
+
+# a review is identified by its reviewer, product and time
+REVIEW_KEY_COLUMNS = [REVIEWER_ID, PRODUCT_ID, UNIX_REVIEW_TIME]
+
+
+def _review_key_hashes(review_df):
+    """
+    64-bit hash of the key of every review
+    """
+    keys_df = review_df[REVIEW_KEY_COLUMNS].astype({REVIEWER_ID: str, PRODUCT_ID: str, UNIX_REVIEW_TIME: np.int64})
+    return pd.util.hash_pandas_object(keys_df, index=False).to_numpy()
+
+
+def _key_index(data_path):
+    """
+    Sorted review key hashes of a review cache file, saved next to it.
+    Built on first use for files written before incremental ingest was used
+    """
+    key_index_path = f'{data_path}.keys.npy'
+    if not os.path.exists(key_index_path):
+        keys_df = pq.read_table(data_path, columns=REVIEW_KEY_COLUMNS).to_pandas()
+        np.save(key_index_path, np.sort(_review_key_hashes(keys_df)))
+    return np.load(key_index_path, mmap_mode='r')
+
+
+def _is_known_review(key_hashes, cache_dir):
+    """
+    Check which review key hashes are already in the review cache, using a
+    binary search in the key index of every cache file
+    """
+    known = np.zeros(len(key_hashes), dtype=bool)
+    for data_path in cache_files(cache_dir, REVIEW_CACHE):
+        key_index = _key_index(data_path)
+        if len(key_index) == 0:
+            continue
+        positions = np.minimum(np.searchsorted(key_index, key_hashes), len(key_index) - 1)
+        known |= key_index[positions] == key_hashes
+    return known
+
+
+def ingest_new_reviews(cache_dir, filenames, source_files, review_files):
+    """
+    Add reviews from new review dumps to the cache
+    - drop reviews already in the cache or repeated in the dumps, keyed by (reviewer, product, time)
+    - append the new reviews to the review cache as a new part
+    - append their raw text to the text store, if it has the texts of every review of the cache
+      (built from the raw review files review_files)
+    - append the aggregates of the new reviews to the aggregate store (see append_aggregate_store)
+      and merge them into the review moments
+    Existing reviews and aggregates are not rewritten, apart from the category level and the moments
+    which have a few rows. Review keys are looked up in the sorted key index of every part, and
+    the product IDs of the product level are read to count new products. Returns the number of new reviews
+    """
+    review_df = concat_processed([load_review_file(filename) for filename in filenames]).reset_index(drop=True)
+    key_hashes = _review_key_hashes(review_df)
+    new = ~pd.Series(key_hashes).duplicated().to_numpy() & ~_is_known_review(key_hashes, cache_dir)
+    review_df, key_hashes = review_df[new], key_hashes[new]
+    if review_df.empty:
+        return 0
+
+    # the text store is kept up to date if it has the texts of every review already in the cache
+    update_text_store = is_text_store_valid(cache_dir, review_files)
+    if update_text_store:
+        texts_df = pd.concat([texts_df for filename in filenames
+                              for texts_df in iter_review_texts(filename)]).reset_index(drop=True)[new]
+        # shards are named after the review cache part, they sort after the shards of the raw files
+        shard = f'part{len(cache_files(cache_dir, REVIEW_CACHE)):04d}'
+        for column in texts_df.columns:
+            write_text_shard(text_store_dir(cache_dir), f'{column}.{shard}', *encode_texts(texts_df[column]))
+    part_path = append_cache(cache_dir, REVIEW_CACHE, review_df, filenames)
+    np.save(f'{part_path}.keys.npy', np.sort(key_hashes))
+    if update_text_store:
+        save_text_store(cache_dir, review_files)
+
+    review_metadata_df = load_cache(cache_dir, METADATA_CACHE, columns=AGGREGATE_METADATA_COLUMNS)
+    product_index = load_product_index(cache_dir)
+    append_aggregate_store(cache_dir, review_df, review_metadata_df, product_index, source_files, filenames)
+    moments = merge_moments(load_moments(cache_dir),
+                            chunk_moments(review_moment_values(review_df, review_metadata_df, product_index)))
+    save_moments(cache_dir, moments, source_files)
+    return len(review_df.index)
@@ -1,6 +1,14 @@
+import numpy as np
 import pandas as pd
 import os
 import ast
+import io
+import itertools
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+from text_statistics import *
+from profiling import profile_stage, enable_profiling, is_profiling_enabled, pop_profile_records, add_profile_records
 
 DATA_DIR = 'data'
 
@@ -16,6 +24,13 @@ METADATA_FILES = {
     'all': 'metadata.csv'
 }
 
+# number of rows processed at a time when streaming raw data
+DEFAULT_CHUNKSIZE = 100000
+# raw review files are parsed in parallel in byte ranges of at least this size
+MIN_SPLIT_BYTES = 16 * 2 ** 20
+# size of the blocks read when scanning raw files for record boundaries
+READ_BLOCK_BYTES = 16 * 2 ** 20
+
 # reviewer fields
 REVIEWER_ID = 'reviewerID'
 PRODUCT_ID = 'asin'
@@ -41,10 +56,19 @@ BOUGHT_TOGETHER = 'bought_together'
 SUMMARY_LENGTH = 'summaryLength'
 CATEGORY = 'category'
 REVIEW_WORD_COUNT = 'reviewTextLength'
+REVIEW_CHARACTER_COUNT = 'reviewTextCharacterCount'
+REVIEW_SENTENCE_COUNT = 'reviewTextSentenceCount'
+SUMMARY_CHARACTER_COUNT = 'summaryCharacterCount'
 NUM_HELPFUL = 'numHelpful'
 NUM_UNHELPFUL = 'numUnhelpful'
 NUM_HELPFULNESS_VOTES = 'numHelpfulnessVotes'
 PRODUCT_DESCRIPTION_LENGTH = 'productDescriptionLength'
+# period of the review time (UTC), month from 1 to 12
+YEAR = 'year'
+MONTH = 'month'
+# statistics of the products bought together with a product
+NUM_BOUGHT_TOGETHER = 'numBoughtTogether'
+BOUGHT_TOGETHER_RATING = 'boughtTogetherRating'
 
 DISPLAY_NAMES_DICT = {
     REVIEWER_ID: 'Reviewer ID',
@@ -58,9 +82,16 @@ DISPLAY_NAMES_DICT = {
     BRAND: 'Brand',
     CATEGORY: 'Product Category',
     REVIEW_WORD_COUNT: 'Review Word Count',
+    REVIEW_CHARACTER_COUNT: 'Review Character Count',
+    REVIEW_SENTENCE_COUNT: 'Review Sentence Count',
+    SUMMARY_CHARACTER_COUNT: 'Summary Character Count',
     NUM_HELPFUL: 'Number of Helpful Votes',
     NUM_UNHELPFUL: 'Number of Unhelpful Votes',
-    NUM_HELPFULNESS_VOTES: 'Total # of Helpfulness Votes'
+    NUM_HELPFULNESS_VOTES: 'Total # of Helpfulness Votes',
+    YEAR: 'Year',
+    MONTH: 'Month',
+    NUM_BOUGHT_TOGETHER: 'Number of Products Bought Together',
+    BOUGHT_TOGETHER_RATING: 'Rating of Products Bought Together'
 }
 
 REVIEW_COLUMNS = [REVIEWER_ID,
@@ -73,6 +104,9 @@ REVIEW_COLUMNS = [REVIEWER_ID,
                   UNIX_REVIEW_TIME,
                   REVIEW_TIME]
 
+# reviewTime duplicates unixReviewTime as a string and is not loaded
+LOADED_REVIEW_COLUMNS = [column for column in REVIEW_COLUMNS if column != REVIEW_TIME]
+
 PRODUCT_COLUMNS = [PRODUCT_ID,
                    SALES_RANK,
                    PRODUCT_TITLE,
@@ -81,8 +115,61 @@ PRODUCT_COLUMNS = [PRODUCT_ID,
                    RELATED_PRODUCTS,
                    BRAND]
 
-# data pre-processing functions
-TEXT_SUMMARY_FUNCTION = lambda x: len(x.split())
+# compact in-memory types of the processed data
+# - IDs, names and categories -> categoricals, Product IDs share codes between review and product data
+# - ratings, counts and times -> smallest type holding their range, vote counts and sales ranks
+#   are float since they can be missing, sales ranks are float64 as they exceed the 2^24 integers
+#   float32 holds exactly
+CATEGORICAL_COLUMNS = [REVIEWER_ID, PRODUCT_ID, REVIEWER_NAME, CATEGORY, BRAND]
+COMPACT_DTYPES = {
+    **{column: 'category' for column in CATEGORICAL_COLUMNS},
+    RATING: np.int8,
+    UNIX_REVIEW_TIME: np.int32,
+    REVIEW_WORD_COUNT: np.int32,
+    REVIEW_CHARACTER_COUNT: np.int32,
+    REVIEW_SENTENCE_COUNT: np.int32,
+    SUMMARY_LENGTH: np.int32,
+    SUMMARY_CHARACTER_COUNT: np.int32,
+    PRODUCT_DESCRIPTION_LENGTH: np.int32,
+    YEAR: np.int16,
+    MONTH: np.int8,
+    HELPFULNESS: np.float32,
+    NUM_HELPFUL: np.float32,
+    NUM_UNHELPFUL: np.float32,
+    SALES_RANK: np.float64
+}
+
+# IDs of raw review data are parsed directly into categoricals
+REVIEW_ID_DTYPES = {REVIEWER_ID: 'category', PRODUCT_ID: 'category', REVIEWER_NAME: 'category'}
+
+# fraction of reviews kept in approximate mode
+DEFAULT_SAMPLE_FRACTION = 0.01
+
+# text fields are replaced by their statistics (see text_statistics) when raw data is read,
+# text field -> {statistic: column}
+REVIEW_TEXT_STATISTICS = {
+    REVIEW_TEXT: {NUM_WORDS: REVIEW_WORD_COUNT,
+                  NUM_CHARACTERS: REVIEW_CHARACTER_COUNT,
+                  NUM_SENTENCES: REVIEW_SENTENCE_COUNT},
+    SUMMARY: {NUM_WORDS: SUMMARY_LENGTH, NUM_CHARACTERS: SUMMARY_CHARACTER_COUNT}
+}
+METADATA_TEXT_STATISTICS = {PRODUCT_DESCRIPTION: {NUM_WORDS: PRODUCT_DESCRIPTION_LENGTH}}
+# text fields of raw data are read this many rows at a time, so that only the statistics of
+# earlier rows are kept in memory
+TEXT_CHUNKSIZE = DEFAULT_CHUNKSIZE
+# strings read as missing values in columns other than text fields, the default of read_csv
+DEFAULT_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                     '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'n/a', 'nan', 'null']
+
+# fast-path patterns for vectorized parsing, rows which do not match fall back to ast.literal_eval
+# helpful -> [2, 3]
+HELPFULNESS_PATTERN = r'^\[(\d+), (\d+)\]$'
+# salesRank -> {'Books': 63}
+SALES_RANK_PATTERN = r'''^\{(?:'([^'\\]*)'|"([^"\\]*)"): (\d+)\}$'''
+# related -> {'also_bought': ['B001', 'B002'], 'bought_together': ['B003']}
+RELATED_PRODUCTS_PATTERN = r"^\{(?:'\w+': \[(?:'[^'\\]*'(?:, )?)*\](?:, )?)*\}$"
+BOUGHT_TOGETHER_PATTERN = r"'bought_together': \[((?:'[^'\\]*'(?:, )?)*)\]"
+PRODUCT_ID_PATTERN = r"'([^'\\]*)'"
 
 
 def _process_helpfulness(data):
@@ -139,57 +226,536 @@ def _process_salesrank(data):
     # ensure dict has length 1
     assert len(data_dict) == 1, str(data_dict)
 
-    category = list(data_dict.keys())[0].replace('&amp;', '&')
-    salesrank = data_dict[category]
+    key = list(data_dict.keys())[0]
+    category = key.replace('&amp;', '&')
+    salesrank = data_dict[key]
     return pd.Series([category, salesrank], index=[CATEGORY, SALES_RANK])
 
 
-def _load_data(category):
+def _process_helpfulness_column(data):
+    """
+    Vectorized version of _process_helpfulness over a whole column, returns a dataframe with
+    - # of Helpful Votes
+    - # of Unhelpful Votes
+    - Fraction of Helpful Votes
+    """
+    votes = data.str.extract(HELPFULNESS_PATTERN).astype(float)
+    num_helpful, total = votes[0], votes[1]
+
+    # num_helpful > total -> all fields missing, total == 0 -> no helpfulness fraction
+    valid = ~(num_helpful > total)
+    helpfulness_df = pd.DataFrame({NUM_HELPFUL: num_helpful.where(valid),
+                                   NUM_UNHELPFUL: (total - num_helpful).where(valid),
+                                   HELPFULNESS: (num_helpful / total).where(valid & (total != 0))},
+                                  index=data.index)
+
+    # rows outside the fast path, e.g. extra whitespace
+    fallback = votes[0].isna()
+    if fallback.any():
+        helpfulness_df.loc[fallback] = data[fallback].apply(_process_helpfulness).astype(float)
+    return helpfulness_df
+
+
+def _process_salesrank_column(data):
+    """
+    Vectorized version of _process_salesrank over a whole column, returns a dataframe with
+    - Product Category
+    - Sales Rank
+    """
+    matches = data.str.extract(SALES_RANK_PATTERN)
+    # key is quoted with either single or double quotes
+    category = matches[0].fillna(matches[1]).str.replace('&amp;', '&', regex=False)
+    salesrank_df = pd.DataFrame({CATEGORY: category,
+                                 SALES_RANK: matches[2].astype(float)},
+                                index=data.index)
+
+    # rows outside the fast path, e.g. multiple keys or malformed dicts. Empty dicts and
+    # missing values are already handled since they are left as missing
+    fallback = matches[2].isna() & data.notna() & (data != '{}')
+    if fallback.any():
+        salesrank_df.loc[fallback] = data[fallback].apply(_process_salesrank)
+    salesrank_df[SALES_RANK] = salesrank_df[SALES_RANK].astype(float)
+    return salesrank_df
+
+
+def _process_related_products_column(data):
+    """
+    Vectorized version of _process_related_products over a whole column, returns a series with
+    - list of Product IDs bought together
+    """
+    fast_path = data.str.match(RELATED_PRODUCTS_PATTERN).fillna(False).astype(bool)
+    bought_together = data[fast_path].str.extract(BOUGHT_TOGETHER_PATTERN)[0]
+    # products bought together, records without the key are set to None
+    bought_together = bought_together.str.findall(PRODUCT_ID_PATTERN)
+    bought_together = bought_together.where(bought_together.notna(), None)
+
+    related_products = pd.Series(None, index=data.index, dtype=object)
+    related_products[fast_path] = bought_together
+    # malformed records or records outside the fast path
+    related_products[~fast_path] = data[~fast_path].apply(_process_related_products)
+    return related_products
+
+
+def _process_review_time(unix_review_time):
     """
-    Load and process review data into pandas dataframe
+    Year and month of review times, from the calendar months since the epoch
     """
-    filename = os.path.join(DATA_DIR, REVIEW_FILES[category])
-    # used to obtain word counts
-    converters = {REVIEW_TEXT: TEXT_SUMMARY_FUNCTION,
-                  SUMMARY: TEXT_SUMMARY_FUNCTION
-                  }
+    months = unix_review_time.to_numpy().astype('datetime64[s]').astype('datetime64[M]').astype(np.int64)
+    return pd.DataFrame({YEAR: months // 12 + 1970, MONTH: months % 12 + 1}, index=unix_review_time.index)
 
-    review_df = pd.read_csv(filename,
-                            converters=converters,
-                            usecols=REVIEW_COLUMNS,
-                            )
-    review_df[[NUM_HELPFUL, NUM_UNHELPFUL, HELPFULNESS]] = review_df[HELPFULNESS].apply(_process_helpfulness)
-    review_df = review_df.rename(columns={REVIEW_TEXT: REVIEW_WORD_COUNT, SUMMARY: SUMMARY_LENGTH})
-    return review_df
+
+def compact_dtypes(df):
+    """
+    Convert the columns of processed data to their compact types (COMPACT_DTYPES)
+    """
+    return df.astype({column: dtype for column, dtype in COMPACT_DTYPES.items() if column in df})
+
+
+def _unify_categories(dfs, column):
+    """
+    Give a categorical column the same (sorted) categories in every dataframe, so that equal
+    values have equal integer codes and code order is value order. Dataframes are updated in place
+    """
+    categories = pd.Index(np.concatenate([df[column].cat.categories.to_numpy() for df in dfs])).unique().sort_values()
+    for df in dfs:
+        df[column] = df[column].cat.set_categories(categories)
+
+
+def _concat_categorical(columns, num_rows):
+    """
+    Concatenate categorical columns into a categorical with their (sorted) union of categories,
+    the codes of every column are remapped directly into a preallocated array
+    """
+    categories = pd.Index(np.concatenate([column.cat.categories.to_numpy() for column in columns])).unique().sort_values()
+    codes = np.empty(num_rows, dtype=np.min_scalar_type(-(len(categories) + 1)))
+    start = 0
+    for column in columns:
+        # code -1 (missing value) takes the trailing -1
+        category_codes = np.append(categories.get_indexer(column.cat.categories), -1)
+        codes[start:start + len(column)] = category_codes[column.cat.codes.to_numpy()]
+        start += len(column)
+    return pd.Categorical.from_codes(codes, categories)
+
+
+def concat_processed(dfs):
+    """
+    Concatenate processed dataframes (with the same columns) into a dataframe with a new index
+    - categorical columns stay categorical, with the union of categories
+      (pd.concat falls back to object for categoricals with different categories)
+    - columns of the same numpy type in all dataframes are copied once into a single array,
+      other columns are concatenated by pandas
+    """
+    if len(dfs) == 1:
+        return dfs[0]
+    num_rows = sum(len(df.index) for df in dfs)
+    concatenated = {}
+    for column in dfs[0].columns:
+        columns = [df[column] for df in dfs]
+        dtypes = set(column.dtype for column in columns)
+        if column in CATEGORICAL_COLUMNS and all(isinstance(dtype, pd.CategoricalDtype) for dtype in dtypes):
+            concatenated[column] = _concat_categorical(columns, num_rows)
+        elif len(dtypes) == 1 and isinstance(columns[0].dtype, np.dtype):
+            concatenated[column] = np.concatenate([column.to_numpy() for column in columns])
+        else:
+            concatenated[column] = pd.concat(columns, ignore_index=True)
+    return pd.DataFrame(concatenated)
+
+
+def share_categories(review_df, review_metadata_df):
+    """
+    Encode Product IDs of review and product data with shared integer codes,
+    so that joins between the two tables compare codes rather than strings.
+    Dataframes are updated in place
+    """
+    for df in [review_df, review_metadata_df]:
+        if not isinstance(df[PRODUCT_ID].dtype, pd.CategoricalDtype):
+            df[PRODUCT_ID] = df[PRODUCT_ID].astype('category')
+    _unify_categories([review_df, review_metadata_df], PRODUCT_ID)
+
+
+def _text_read_options(columns, text_columns):
+    """
+    read_csv options reading text fields as they are, e.g. a summary 'NA' is a word rather than a
+    missing value and a missing field is an empty text. Other columns keep the default missing values
+    """
+    return {'dtype': {column: str for column in text_columns},
+            'keep_default_na': False,
+            'na_values': {column: DEFAULT_NA_VALUES for column in columns if column not in text_columns}}
+
+
+def _text_shard(file_index, start=0):
+    """
+    Prefix of the text store shards of a raw file, or of the byte range of a raw file starting at start,
+    shard names sort in the order of the rows of the processed data
+    """
+    return f'{file_index:02d}.{start:012d}.'
+
+
+def _replace_text(df, text_statistics_columns, text_store=None, shard=''):
+    """
+    Replace raw text fields by their statistics (text field -> {statistic: column}, see text_statistics),
+    computed over the whole column at once. The raw text of every field is saved as shard {field}.{shard}
+    of the text_store folder if given
+    """
+    columns = {}
+    with profile_stage('text_statistics') as stage:
+        for column in df.columns:
+            if column not in text_statistics_columns:
+                columns[column] = df[column]
+                continue
+            buffer, offsets = encode_texts(df[column])
+            if text_store is not None:
+                write_text_shard(text_store, f'{column}.{shard}', buffer, offsets)
+            statistics = text_statistics(buffer, offsets, list(text_statistics_columns[column]))
+            for statistic, statistic_column in text_statistics_columns[column].items():
+                columns[statistic_column] = pd.Series(statistics[statistic], index=df.index)
+        stage['rows'] = len(df.index)
+    return pd.DataFrame(columns, index=df.index)
+
+
+def _read_text_chunks(filename, columns, text_statistics_columns, dtype=None, chunksize=None, text_store=None,
+                      shard=''):
+    """
+    Read a raw CSV with text fields replaced by their statistics, either as a single dataframe or as an
+    iterator of dataframes with at most chunksize rows each. Text fields are processed at most
+    TEXT_CHUNKSIZE rows at a time, raw text is saved to text_store in shards {shard}{chunk number}
+    """
+    options = _text_read_options(columns, text_statistics_columns)
+    options['dtype'].update(dtype or {})
+    chunks = pd.read_csv(filename,
+                         usecols=columns,
+                         chunksize=chunksize or TEXT_CHUNKSIZE,
+                         **options)
+    chunks = (_replace_text(df, text_statistics_columns, text_store, f'{shard}{i:06d}') for i, df in enumerate(chunks))
+    if chunksize is not None:
+        return chunks
+    return concat_processed(list(chunks))
+
+
+def _process_review_data(review_df):
+    """
+    Process raw review data (with text fields replaced by their statistics)
+    - split helpfulness field into vote counts and fraction of helpful votes
+    - derive year and month of the review time
+    - convert columns to compact types
+    """
+    with profile_stage('parse_helpfulness') as stage:
+        review_df[[NUM_HELPFUL, NUM_UNHELPFUL, HELPFULNESS]] = _process_helpfulness_column(review_df[HELPFULNESS])
+        stage['rows'] = len(review_df.index)
+    review_df[[YEAR, MONTH]] = _process_review_time(review_df[UNIX_REVIEW_TIME])
+    return compact_dtypes(review_df)
+
+
+def _process_metadata(review_metadata_df):
+    """
+    Process raw product data (with the description replaced by its word count)
+    - split salesrank field into product category and sales rank
+    - extract list of products bought together from related products field
+    - rename related products field
+    - convert columns to compact types
+    """
+    with profile_stage('parse_salesrank') as stage:
+        review_metadata_df[[CATEGORY, SALES_RANK]] = _process_salesrank_column(review_metadata_df[SALES_RANK])
+        stage['rows'] = len(review_metadata_df.index)
+    with profile_stage('parse_related_products') as stage:
+        review_metadata_df[RELATED_PRODUCTS] = _process_related_products_column(review_metadata_df[RELATED_PRODUCTS])
+        stage['rows'] = len(review_metadata_df.index)
+    review_metadata_df = review_metadata_df.rename(columns={RELATED_PRODUCTS: BOUGHT_TOGETHER})
+    return compact_dtypes(review_metadata_df)
+
+
+def _read_data(category, chunksize=None, text_store=None):
+    """
+    Read raw review data, either as a single dataframe or as an iterator of
+    dataframes with at most chunksize rows each
+    """
+    return _read_review_file(os.path.join(DATA_DIR, REVIEW_FILES[category]), chunksize=chunksize,
+                             text_store=text_store, shard=_text_shard(list(REVIEW_FILES).index(category)))
+
+
+def _read_review_file(filename, chunksize=None, text_store=None, shard=''):
+    """
+    Read raw review data from any file in the review data format, with review text and summary
+    replaced by their statistics (REVIEW_TEXT_STATISTICS) and saved to text_store if given
+    """
+    return _read_text_chunks(filename, LOADED_REVIEW_COLUMNS, REVIEW_TEXT_STATISTICS, chunksize=chunksize,
+                             text_store=text_store, shard=shard, dtype=REVIEW_ID_DTYPES)
+
+
+def stratified_sample_mask(strata_df, fraction, rng):
+    """
+    Stratified random sample with proportional allocation, returns a boolean mask of sampled rows
+    - strata are the combinations of values of the columns of strata_df, missing values included
+    - a stratum of n rows keeps floor(fraction * n) random rows, plus one with probability equal to
+      the remainder, so every row has the same probability of being sampled (self-weighting sample)
+    """
+    num_rows = len(strata_df.index)
+    stratum = np.zeros(num_rows, dtype=np.int64)
+    for column in strata_df:
+        codes, uniques = pd.factorize(strata_df[column])
+        stratum = stratum * (len(uniques) + 1) + codes + 1
+    _, stratum = np.unique(stratum, return_inverse=True)
+
+    sizes = np.bincount(stratum)
+    quotas = np.floor(fraction * sizes + rng.random(len(sizes))).astype(np.int64)
+    # random rank of every row within its stratum
+    order = np.lexsort((rng.random(num_rows), stratum))
+    starts = np.cumsum(sizes) - sizes
+    ranks = np.empty(num_rows, dtype=np.int64)
+    ranks[order] = np.arange(num_rows) - starts[stratum[order]]
+    return ranks < quotas[stratum]
+
+
+def _sample_review_file(filename, sample_fraction, product_categories=None, random_state=None,
+                        chunksize=DEFAULT_CHUNKSIZE, text_store=None, shard=''):
+    """
+    Read a stratified sample of raw review data from any file in the review data format
+    - strata : rating, and product category if product_categories (Product ID -> category) is given
+    - the file is read chunk by chunk, text statistics and categorical IDs are only computed for sampled
+      reviews, whose raw text is saved to text_store if given
+    """
+    rng = np.random.default_rng(random_state)
+    samples = []
+    for i, review_df in enumerate(pd.read_csv(filename,
+                                              usecols=LOADED_REVIEW_COLUMNS,
+                                              chunksize=chunksize,
+                                              **_text_read_options(LOADED_REVIEW_COLUMNS, REVIEW_TEXT_STATISTICS))):
+        strata_df = review_df[[RATING]]
+        if product_categories is not None:
+            strata_df = strata_df.assign(**{CATEGORY: review_df[PRODUCT_ID].map(product_categories)})
+        review_df = review_df[stratified_sample_mask(strata_df, sample_fraction, rng)]
+        review_df = _replace_text(review_df, REVIEW_TEXT_STATISTICS, text_store, f'{shard}{i:06d}')
+        samples.append(review_df.astype(REVIEW_ID_DTYPES))
+    return concat_processed(samples)
+
+
+def _read_metadata(category, chunksize=None):
+    """
+    Read raw product data, either as a single dataframe or as an iterator of
+    dataframes with at most chunksize rows each
+    """
+    filename = os.path.join(DATA_DIR, METADATA_FILES[category])
+
+    dtype = {PRODUCT_ID: 'category', BRAND: 'category'}
+
+    return _read_text_chunks(filename, PRODUCT_COLUMNS, METADATA_TEXT_STATISTICS, chunksize=chunksize, dtype=dtype)
+
+
+def _load_data(category, sample_fraction=None, product_categories=None, random_state=None, text_store=None):
+    """
+    Load and process review data into pandas dataframe, or only a stratified sample
+    of sample_fraction of the reviews (see _sample_review_file). The raw text of the
+    loaded reviews is saved to the text_store folder if given
+    """
+    if sample_fraction is not None:
+        with profile_stage(f'sample_reviews:{category}') as stage:
+            review_df = _sample_review_file(os.path.join(DATA_DIR, REVIEW_FILES[category]), sample_fraction,
+                                            product_categories=product_categories, random_state=random_state,
+                                            text_store=text_store,
+                                            shard=_text_shard(list(REVIEW_FILES).index(category)))
+            stage['rows'] = len(review_df.index)
+        return _process_review_data(review_df)
+
+    with profile_stage(f'read_reviews:{category}') as stage:
+        review_df = _read_data(category, text_store=text_store)
+        stage['rows'] = len(review_df.index)
+    return _process_review_data(review_df)
+
+
+def load_review_file(filename):
+    """
+    Load and process review data from any file in the review data format, e.g. a dump of new reviews
+    """
+    with profile_stage(f'read_reviews:{os.path.basename(filename)}') as stage:
+        review_df = _read_review_file(filename)
+        stage['rows'] = len(review_df.index)
+    return _process_review_data(review_df)
+
+
+def _split_review_file(filename, num_splits):
+    """
+    Split a raw review file into up to num_splits byte ranges of whole records, after the header line.
+    A newline ends a record when it follows an even number of quote characters (quotes within
+    quoted fields are escaped by doubling them), so ranges never split a quoted field
+    """
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        start = len(f.readline())
+        boundaries = [start]
+        position, num_quotes = start, 0
+        for split in range(1, num_splits):
+            target = start + (size - start) * split // num_splits
+            if position >= target:
+                continue
+            while position < target:
+                block = f.read(min(target - position, READ_BLOCK_BYTES))
+                num_quotes += block.count(b'"')
+                position += len(block)
+            # first end of a record at or after the target
+            for line in f:
+                num_quotes += line.count(b'"')
+                position += len(line)
+                if num_quotes % 2 == 0:
+                    break
+            if position < size:
+                boundaries.append(position)
+    return list(zip(boundaries, boundaries[1:] + [size]))
+
+
+def _init_ingest_worker(profile=False):
+    """
+    Record stages of raw data parsing in worker processes if profiling
+    """
+    enable_profiling(profile)
+    # forked workers start with a copy of the stages recorded by the parent
+    pop_profile_records()
+
+
+def _load_review_range(filename, start, end, text_store=None, shard=''):
+    """
+    Load and process the raw reviews of a byte range of a review file (see _split_review_file),
+    saving their raw text to text_store if given. Returns the processed reviews and the stages
+    recorded in the worker process
+    """
+    with open(filename, 'rb') as f:
+        header = f.readline()
+        f.seek(start)
+        data = header + f.read(end - start)
+    with profile_stage(f'read_reviews:{os.path.basename(filename)}:{start}') as stage:
+        review_df = _read_review_file(io.BytesIO(data), text_store=text_store, shard=shard)
+        stage['rows'] = len(review_df.index)
+    return _process_review_data(review_df), pop_profile_records()
+
+
+def _load_review_data_parallel(load_all_data, num_workers, text_store=None):
+    """
+    Parallel counterpart of load_review_data
+    - split raw review files into byte ranges of whole records, of at least MIN_SPLIT_BYTES and
+      about 2 per worker across all files
+    - parse and process ranges in a pool of num_workers processes, meanwhile this process loads
+      product data
+    - concatenate processed ranges in file order, the result is the same as a sequential load
+    """
+    review_files, _ = review_data_files(load_all_data=load_all_data)
+    split_bytes = max(MIN_SPLIT_BYTES, sum(os.path.getsize(filename) for filename in review_files) / (2 * num_workers))
+    ranges = [(filename, start, end, text_store, _text_shard(file_index, start))
+              for file_index, filename in enumerate(review_files)
+              for start, end in _split_review_file(filename, max(1, math.ceil(os.path.getsize(filename) / split_bytes)))]
+
+    with ProcessPoolExecutor(max_workers=min(num_workers, len(ranges)), initializer=_init_ingest_worker,
+                             initargs=(is_profiling_enabled(),)) as executor:
+        results = executor.map(_load_review_range, *zip(*ranges))
+        review_metadata_df = _load_metadata('all' if load_all_data else 'clothing')
+        review_dfs = []
+        for review_df, records in results:
+            review_dfs.append(review_df)
+            add_profile_records(records)
+
+    review_df = concat_processed(review_dfs)
+    share_categories(review_df, review_metadata_df)
+    return review_df, review_metadata_df
 
 
 def _load_metadata(category):
     """
     Load and process review metadat (or product data) into pandas dataframe
     """
-    filename = os.path.join(DATA_DIR, METADATA_FILES[category])
+    with profile_stage(f'read_metadata:{category}') as stage:
+        review_metadata_df = _read_metadata(category)
+        stage['rows'] = len(review_metadata_df.index)
+    return _process_metadata(review_metadata_df)
+
+
+def _iter_data(category, chunksize=DEFAULT_CHUNKSIZE, text_store=None):
+    """
+    Load and process review data chunk by chunk
+    """
+    for review_df in _read_data(category, chunksize=chunksize, text_store=text_store):
+        yield _process_review_data(review_df)
+
+
+def _iter_metadata(category, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Load and process review metadata (or product data) chunk by chunk
+    """
+    for review_metadata_df in _read_metadata(category, chunksize=chunksize):
+        yield _process_metadata(review_metadata_df)
 
-    converters = {RELATED_PRODUCTS: _process_related_products,
-                  PRODUCT_DESCRIPTION: TEXT_SUMMARY_FUNCTION}
 
-    review_metadata_df = pd.read_csv(filename,
-                                     converters=converters,
-                                     usecols=PRODUCT_COLUMNS
-                                     )
-    review_metadata_df[[CATEGORY, SALES_RANK]] = review_metadata_df[SALES_RANK].apply(_process_salesrank)
-    review_metadata_df = review_metadata_df.rename(columns={RELATED_PRODUCTS: BOUGHT_TOGETHER,
-                                                            PRODUCT_DESCRIPTION: PRODUCT_DESCRIPTION_LENGTH})
-    return review_metadata_df
+def load_review_data(load_all_data=False, sample_fraction=None, random_state=None, num_workers=1, text_store=None):
+    """
+    Load and process review and product data, with Product IDs encoded
+    with the same integer codes in both. With sample_fraction, only a sample of reviews
+    stratified by product category and rating is loaded, product data is loaded in full
+    since it gives the category of every review. Full review data is parsed across
+    num_workers processes (see _load_review_data_parallel). The raw text of the loaded
+    reviews is saved to the text_store folder if given (see text_store.py)
+    """
+    if num_workers > 1 and sample_fraction is None:
+        return _load_review_data_parallel(load_all_data, num_workers, text_store=text_store)
 
+    review_metadata_df = _load_metadata('all' if load_all_data else 'clothing')
+    rng = np.random.default_rng(random_state)
+    product_categories = None
+    if sample_fraction is not None:
+        product_categories = review_metadata_df.drop_duplicates(PRODUCT_ID).set_index(PRODUCT_ID)[CATEGORY]
+
+    review_df = []
+    for category in (REVIEW_FILES if load_all_data else ['clothing']):
+        review_df.append(_load_data(category, sample_fraction=sample_fraction, product_categories=product_categories,
+                                    random_state=rng, text_store=text_store))
+    review_df = concat_processed(review_df)
+    share_categories(review_df, review_metadata_df)
+    return review_df, review_metadata_df
 
-def load_review_data(load_all_data=False):
+
+def review_data_files(load_all_data=False):
+    """
+    Paths of the raw review and product data files used by load_review_data
+    """
     if load_all_data:
-        review_df = []
-        for category in REVIEW_FILES:
-            review_df.append(_load_data(category))
-        review_df = pd.concat(review_df)
-        review_metadata_df = _load_metadata('all')
+        review_files = [os.path.join(DATA_DIR, REVIEW_FILES[category]) for category in REVIEW_FILES]
+        metadata_files = [os.path.join(DATA_DIR, METADATA_FILES['all'])]
     else:
-        review_df = _load_data('clothing')
-        review_metadata_df = _load_metadata('clothing')
-    return review_df, review_metadata_df
+        review_files = [os.path.join(DATA_DIR, REVIEW_FILES['clothing'])]
+        metadata_files = [os.path.join(DATA_DIR, METADATA_FILES['clothing'])]
+    return review_files, metadata_files
+
+
+def iter_review_data(load_all_data=False, chunksize=DEFAULT_CHUNKSIZE, text_store=None):
+    """
+    Streaming counterpart of load_review_data, returns iterators over
+    processed review and product data chunks of at most chunksize rows
+    """
+    if load_all_data:
+        review_chunks = itertools.chain.from_iterable(_iter_data(category, chunksize=chunksize, text_store=text_store)
+                                                      for category in REVIEW_FILES)
+        metadata_chunks = _iter_metadata('all', chunksize=chunksize)
+    else:
+        review_chunks = _iter_data('clothing', chunksize=chunksize, text_store=text_store)
+        metadata_chunks = _iter_metadata('clothing', chunksize=chunksize)
+    return review_chunks, metadata_chunks
+
+
+def iter_review_texts(filename, chunksize=TEXT_CHUNKSIZE):
+    """
+    Iterate over the raw text fields (REVIEW_TEXT_STATISTICS) of any file in the review data format,
+    as dataframes of at most chunksize rows, in the order of the reviews
+    """
+    text_columns = list(REVIEW_TEXT_STATISTICS)
+    return pd.read_csv(filename, usecols=text_columns, chunksize=chunksize,
+                       **_text_read_options(text_columns, text_columns))
+
+
+def save_review_texts(text_store, load_all_data=False):
+    """
+    Save the raw text of the reviews of the raw data files to the text_store folder without processing
+    the reviews, in shards that sort in the order of the reviews as when the text is saved while loading
+    """
+    categories = REVIEW_FILES if load_all_data else ['clothing']
+    for category in categories:
+        shard = _text_shard(list(REVIEW_FILES).index(category))
+        for i, texts_df in enumerate(iter_review_texts(os.path.join(DATA_DIR, REVIEW_FILES[category]))):
+            for column in texts_df.columns:
+                write_text_shard(text_store, f'{column}.{shard}{i:06d}', *encode_texts(texts_df[column]))
+
@@ -1,47 +1,97 @@
 import argparse
+import matplotlib
+import numpy as np
 import seaborn as sns
-import random
+from concurrent.futures import ProcessPoolExecutor
 from tabulate import tabulate
 
+import load_data
 from load_data import *
 from analysis import *
+from cache import *
+from aggregates import *
+from incremental import *
+from graph import *
+from memoize import *
+from moments import *
+from partitioned import *
+from product_index import *
+from profiling import *
+from text_store import *
+
+ANALYSIS_TYPES = [1, 2, 3, 4, 5, 6]
+
+# columns of the preprocessed review data used by Q1, other analyses use the aggregate store
+Q1_REVIEW_COLUMNS = [HELPFULNESS, NUM_HELPFUL, NUM_UNHELPFUL, RATING, REVIEW_WORD_COUNT, SUMMARY_LENGTH]
+# columns of the preprocessed product data used by Q5
+Q5_METADATA_COLUMNS = [PRODUCT_ID, BOUGHT_TOGETHER]
+
+# inputs of each analysis, either preprocessed data or a level of the aggregate store
+ANALYSIS_INPUTS = {
+    1: [REVIEW_CACHE, MOMENTS_CACHE],
+    2: [CATEGORY_AGGREGATES],
+    3: [PRODUCT_AGGREGATES, CATEGORY_AGGREGATES],
+    4: [REVIEWER_AGGREGATES],
+    5: [PRODUCT_AGGREGATES, METADATA_CACHE, GRAPH_CACHE, PRODUCT_INDEX_CACHE],
+    6: [YEAR_PRODUCT_AGGREGATES, MONTH_PRODUCT_AGGREGATES]
+}
+# additional inputs of analyses reporting bootstrap confidence intervals (approximate mode)
+BOOTSTRAP_INPUTS = {
+    2: [PRODUCT_AGGREGATES]
+}
+# number of bootstrap resamples of confidence intervals in approximate mode
+NUM_BOOTSTRAP = 200
+# prefix of columns counting the reviews or products of a sample (approximate mode)
+SAMPLE_PREFIX = 'sample_'
 
 # Q2
-def review_behavior_by_category(joined_df, metric, num_top_categories=10):
+@memoize(CATEGORY_AGGREGATES, PRODUCT_AGGREGATES)
+def review_behavior_by_category(category_aggregates_df, metric, num_top_categories=10,
+                                product_aggregates_df=None, num_bootstrap=None, sampled=False):
     """
-    Group reviews by category and
+    Use per-category aggregates to
     - obtain # of reviews per # of products in each category
     - select top 10 categories using this criteria
     - sort data by average metric, e.g. RATING, REVIEW_WORD_COUNT etc.
+    - optionally add bootstrap confidence intervals of the average metric, resampling products
+      from per-product aggregates
+    Counts of sampled aggregates (approximate mode) are those of the sample and are reported as
+    sample_ columns, e.g. sample_reviews_per_product
     """
-    grouped_df = joined_df[[CATEGORY, metric, PRODUCT_ID]].groupby(CATEGORY) \
-        .agg({metric: ['mean', 'count'], PRODUCT_ID: ['nunique']})
-    # flatten 2-level column hierarchy
-    grouped_df.columns = ["_".join(x) for x in grouped_df.columns.ravel()]
+    category_aggregates_df = category_aggregates_df.set_index(CATEGORY)
+    grouped_df = pd.DataFrame({f'{metric}_mean': aggregate_mean(category_aggregates_df, metric),
+                               f'{metric}_count': category_aggregates_df[f'{metric}_count'],
+                               f'{PRODUCT_ID}_nunique': category_aggregates_df[f'{PRODUCT_ID}_nunique']})
 
     # reviews_per_product -> # of reviews / # of products
     grouped_df['reviews_per_product'] = grouped_df[f'{metric}_count'] / grouped_df[f'{PRODUCT_ID}_nunique']
     grouped_df = grouped_df.nlargest(num_top_categories, f'{metric}_count').sort_values(f'{metric}_mean',
                                                                                         ascending=False)
+    if num_bootstrap is not None:
+        top_products_df = product_aggregates_df[product_aggregates_df[CATEGORY].isin(grouped_df.index)]
+        grouped_df = grouped_df.join(bootstrap_aggregate_mean(top_products_df, metric, CATEGORY, num_bootstrap))
+    if sampled:
+        # the number of products of a sample underestimates the number of products of all reviews,
+        # so counts of the sample are not scaled up
+        grouped_df = grouped_df.rename(columns={column: f'{SAMPLE_PREFIX}{column}' for column in
+                                                [f'{metric}_count', f'{PRODUCT_ID}_nunique', 'reviews_per_product']})
+    # plain labels, a categorical would keep every category in plot legends and facets
+    grouped_df.index = grouped_df.index.astype(str)
     return grouped_df.reset_index()
 
 
 # Q3
-def get_average_metric_with_price(data, metadata, metric):
+@memoize(PRODUCT_AGGREGATES)
+def get_average_metric_with_price(product_aggregates_df, metric):
     """
-    Group data per product
+    Use per-product aggregates to obtain
     - product price
     - average metric, e.g. RATING, REVIEW_WORD_COUNT etc.
     """
-    # aggregate metric (e.g. rating) in review table
-    product_metric_df = data[[PRODUCT_ID, metric]].groupby(PRODUCT_ID).agg({metric: ['mean']})
-    product_metric_df.columns = ["_".join(x) for x in product_metric_df.columns.ravel()]
-
-    # join with product table to get price and category
-    product_price_metric_df = product_metric_df \
-        .join(metadata[[PRODUCT_ID, PRICE, CATEGORY]] \
-              .set_index(PRODUCT_ID)) \
-        .reset_index()
+    product_price_metric_df = pd.DataFrame({PRODUCT_ID: product_aggregates_df[PRODUCT_ID],
+                                            f'{metric}_mean': aggregate_mean(product_aggregates_df, metric),
+                                            PRICE: product_aggregates_df[PRICE],
+                                            CATEGORY: product_aggregates_df[CATEGORY]})
 
     # drop products with price missing if any
     product_price_metric_df = product_price_metric_df[product_price_metric_df[PRICE].notna()]
@@ -49,42 +99,357 @@ def get_average_metric_with_price(data, metadata, metric):
 
 
 # Q5
-def sample_products_bought_together(data, metadata, num_samples=10000):
+@memoize(PRODUCT_AGGREGATES, METADATA_CACHE)
+def _bought_together_edges(product_aggregates_df, metadata):
+    """
+    Flatten products bought together into integer coded product pairs
+    - Product IDs and average ratings of rated products, indexed by product code
+    - product codes of every pair (P1, P2) where both products are rated
+    - sampling weight of every pair, 1 / # of products bought together with P1,
+      i.e. P1 is selected uniformly and P2 uniformly among products bought with P1
+    """
+    product_rating = aggregate_mean(product_aggregates_df, RATING)
+    product_ids = pd.Index(product_aggregates_df[PRODUCT_ID].astype(str))
+
+    bought_together_df = metadata[[PRODUCT_ID, BOUGHT_TOGETHER]]
+    bought_together_df = bought_together_df[bought_together_df[BOUGHT_TOGETHER].notnull()]
+    # one row per (P1, P2) pair, empty lists result in a missing P2
+    pairs_df = bought_together_df.explode(BOUGHT_TOGETHER)
+    pairs_df = pairs_df[pairs_df[BOUGHT_TOGETHER].notnull()]
+    num_bought_together = pairs_df.groupby(level=0)[BOUGHT_TOGETHER].transform('size').to_numpy()
+
+    # product codes, -1 for products without ratings
+    product_index = build_product_index(product_ids)
+    item1 = product_rows(pairs_df[PRODUCT_ID], product_index)
+    item2 = product_rows(pairs_df[BOUGHT_TOGETHER], product_index)
+    rated = (item1 >= 0) & (item2 >= 0)
+    return product_ids, product_rating.to_numpy(), item1[rated], item2[rated], 1.0 / num_bought_together[rated]
+
+
+def sample_products_bought_together(product_aggregates_df, metadata, num_samples=10000, random_state=None,
+                                    edges=None):
     """
     - Select random product : P1
     - Select random product bought together with it : P2
     - Obtain Average rating of P1 : R1
     - Obtain Average rating of P2 : R2
     - Add [P1, R1, P2, R2] to a dataframe
-    Repeat the above steps until we have 10000 product pairs
+    Pairs where either product has no rating are skipped. All num_samples pairs are drawn
+    at once from the flattened pairs, with num_samples=None every pair is returned instead.
+    Flattened pairs already computed with _bought_together_edges can be passed as edges
     """
-    product_rating_df = data[[PRODUCT_ID, RATING]].groupby(PRODUCT_ID).agg({RATING: ['mean']})
-    product_rating_df.columns = ["_".join(x) for x in product_rating_df.columns.ravel()]
+    if edges is None:
+        edges = _bought_together_edges(product_aggregates_df, metadata)
+    product_ids, product_ratings, item1, item2, weights = edges
 
-    bought_together_df = metadata[[PRODUCT_ID, BOUGHT_TOGETHER]]
-    bought_together_df = bought_together_df[bought_together_df[BOUGHT_TOGETHER].notnull()]
-    rating_pair_df = pd.DataFrame(columns=['Product_ID_1', 'Rating_1', 'Product_ID_2', 'Rating_2'])
+    if num_samples is not None:
+        rng = np.random.default_rng(random_state)
+        samples = rng.choice(len(item1), size=num_samples, p=weights / weights.sum())
+        item1, item2 = item1[samples], item2[samples]
+
+    return pd.DataFrame({'Product_ID_1': product_ids[item1],
+                         'Rating_1': product_ratings[item1],
+                         'Product_ID_2': product_ids[item2],
+                         'Rating_2': product_ratings[item2]})
+
+
+def bought_together_neighborhoods(product_aggregates_df, graph, product_index):
+    """
+    Exact counterpart of sample_products_bought_together over the whole co-purchase graph
+    - average rating of every rated product, with the number of products bought together with it
+      and the number and average rating of those that are rated
+    - assortativity of rating, i.e. correlation of average ratings over all rated pairs (P1, P2),
+      with the number of pairs
+    """
+    rows = product_rows(product_aggregates_df[PRODUCT_ID], product_index)
+    ratings = np.full(len(graph['indptr']) - 1, np.nan)
+    ratings[rows[rows >= 0]] = aggregate_mean(product_aggregates_df, RATING).to_numpy()[rows >= 0]
 
-    found_samples = 0
-    while found_samples < num_samples:
-        random_record = bought_together_df.sample().iloc[0]
-        item1 = random_record[PRODUCT_ID]
-        item2 = random.choice(ast.literal_eval(random_record[BOUGHT_TOGETHER]))
+    neighborhood_df = neighbor_statistics(graph, ratings, BOUGHT_TOGETHER_RATING)
+    neighborhood_df.insert(0, f'{RATING}_mean', ratings)
+    return neighborhood_df[neighborhood_df[f'{RATING}_mean'].notna()], assortativity(graph, ratings)
 
-        try:
-            rating1 = product_rating_df._get_value(item1, f'{RATING}_mean')
-            rating2 = product_rating_df._get_value(item2, f'{RATING}_mean')
-        except KeyError:
-            continue
 
-        rating_pair_df = rating_pair_df.append({'Product_ID_1': item1,
-                                                'Rating_1': rating1,
-                                                'Product_ID_2': item2,
-                                                'Rating_2': rating2},
-                                               ignore_index=True)
-        found_samples += 1
+# Q4
+def reviewer_summary(reviewer_aggregates_df):
+    """
+    Use per-reviewer aggregates to obtain the average price of the products reviewed
+    and the # of reviews of every reviewer
+    """
+    return pd.DataFrame({f'{PRICE}_mean': aggregate_mean(reviewer_aggregates_df, PRICE),
+                         'Number of Reviews': reviewer_aggregates_df[NUM_REVIEWS]})
+
+
+# Q6
+def period_trend(month_product_aggregates_df, period=YEAR):
+    """
+    Use per (year, month, product) aggregates, or per month aggregates already rolled up over products,
+    to obtain per year or month over all products
+    - # of reviews
+    - average rating, review word count and helpfulness
+    Months also get a 'period' column with the date of their first day
+    """
+    period_df = period_rollup(month_product_aggregates_df, period, by=None)
+    trend_df = period_df[PERIOD_KEYS[period] + [NUM_REVIEWS]].copy()
+    if period == MONTH:
+        trend_df['period'] = pd.to_datetime(pd.DataFrame({'year': trend_df[YEAR], 'month': trend_df[MONTH], 'day': 1}))
+    for metric in [RATING, REVIEW_WORD_COUNT, HELPFULNESS]:
+        trend_df[f'{metric}_mean'] = aggregate_mean(period_df, metric)
+    return trend_df
 
-    return rating_pair_df
+
+def load_analysis_data(cache_dir, analysis_types, bootstrap=False, years=None):
+    """
+    Load the inputs of all selected analyses once, keyed by preprocessed data / aggregate level.
+    years=(first, last) restricts aggregates per period to these years
+    """
+    inputs = set(data_name for analysis_type in analysis_types for data_name in ANALYSIS_INPUTS[analysis_type])
+    if bootstrap:
+        inputs.update(data_name for analysis_type in analysis_types
+                      for data_name in BOOTSTRAP_INPUTS.get(analysis_type, []))
+    data = {}
+    for data_name in inputs:
+        if data_name == REVIEW_CACHE:
+            data[data_name] = load_cache(cache_dir, REVIEW_CACHE, columns=Q1_REVIEW_COLUMNS)
+        elif data_name == METADATA_CACHE:
+            data[data_name] = load_cache(cache_dir, METADATA_CACHE, columns=Q5_METADATA_COLUMNS)
+        elif data_name == MOMENTS_CACHE:
+            data[data_name] = load_moments(cache_dir)
+        elif data_name == GRAPH_CACHE:
+            data[data_name] = load_bought_together_graph(cache_dir)
+        elif data_name == PRODUCT_INDEX_CACHE:
+            data[data_name] = load_product_index(cache_dir)
+        else:
+            data[data_name] = load_aggregates(cache_dir, data_name, years=years)
+    return data
+
+
+def analysis_1(data, result_dir, num_bootstrap=None):
+    """
+    Q1: What is the relation between the reviews and the helpfulness?
+    """
+    review_df = data[REVIEW_CACHE]
+    # correlations of all review columns, accumulated when the reviews were pre-processed
+    correlation_df = correlation_matrix(data[MOMENTS_CACHE])
+
+    print_correlation(review_df, HELPFULNESS, RATING, "helpfulness", "rating", num_bootstrap=num_bootstrap,
+                      correlation=correlation_df.loc[HELPFULNESS, RATING])
+    print_correlation(review_df, HELPFULNESS, REVIEW_WORD_COUNT, "helpfulness", "review word count",
+                      num_bootstrap=num_bootstrap, correlation=correlation_df.loc[HELPFULNESS, REVIEW_WORD_COUNT])
+    print_correlation(review_df, HELPFULNESS, SUMMARY_LENGTH, "helpfulness", "summary length",
+                      num_bootstrap=num_bootstrap, correlation=correlation_df.loc[HELPFULNESS, SUMMARY_LENGTH])
+
+    # mean and standard deviation of helpfulness per rating
+    helpfulness_by_rating = review_df.groupby(RATING)[HELPFULNESS]
+    rating_helpfulness_df = pd.DataFrame({HELPFULNESS: helpfulness_by_rating.mean(),
+                                          f'{HELPFULNESS}_std': helpfulness_by_rating.std(ddof=0)}).reset_index()
+
+    # plots of all reviews are rendered from bins computed over all rows
+    return [(plot_binned_histogram, (f'{result_dir}/Q1/helpfulness_histogram.png',
+                                     histogram_bins(review_df[HELPFULNESS])),
+             {}),
+            (plot_binned_histogram, (f'{result_dir}/Q1/num_helpful_histogram.png',
+                                     histogram_bins(review_df[NUM_HELPFUL])),
+             {'log': True}),
+            (plot_binned_histogram, (f'{result_dir}/Q1/num_unhelpful_histogram.png',
+                                     histogram_bins(review_df[NUM_UNHELPFUL], bins=100)),
+             {'log': True}),
+            (binned_joint_plot, (f'{result_dir}/Q1/wordcount_helpfulness_joint.png',
+                                 density_bins(review_df[REVIEW_WORD_COUNT], review_df[HELPFULNESS])),
+             {}),
+            (binned_joint_plot, (f'{result_dir}/Q1/rating_helpfulness_joint.png',
+                                 density_bins(review_df[RATING], review_df[HELPFULNESS])),
+             {}),
+            (bar_plot, (f'{result_dir}/Q1/rating_helpfulness_barplot.png', rating_helpfulness_df, RATING, HELPFULNESS),
+             {'yerr': f'{HELPFULNESS}_std'}),
+            (binned_joint_plot, (f'{result_dir}/Q1/helpfulness_rating_jointplot.png',
+                                 density_bins(review_df[HELPFULNESS], review_df[RATING])),
+             {})]
+
+
+def analysis_2(data, result_dir, num_bootstrap=None):
+    """
+    Q2: What is the review behavior among different categories?
+    """
+    metric = RATING
+    category_aggregates_df = data[CATEGORY_AGGREGATES]
+    # confidence intervals are only reported in approximate mode, i.e. on sampled data
+    sampled = num_bootstrap is not None
+    review_by_category_df = review_behavior_by_category(category_aggregates_df, metric,
+                                                        product_aggregates_df=data.get(PRODUCT_AGGREGATES),
+                                                        num_bootstrap=num_bootstrap, sampled=sampled)
+    print(tabulate(review_by_category_df, headers='keys', tablefmt='psql'))
+
+    # mean and standard deviation of top categories from their aggregates
+    filtered_df = category_aggregates_df.set_index(CATEGORY).loc[review_by_category_df[CATEGORY]]
+    filtered_df = pd.DataFrame({CATEGORY: review_by_category_df[CATEGORY],
+                                metric: aggregate_mean(filtered_df, metric).to_numpy(),
+                                f'{metric}_std': aggregate_std(filtered_df, metric).to_numpy()})
+
+    return [(scatter_plot, (f'{result_dir}/Q2/rating_numreviews_scatterplot.png', review_by_category_df,
+                            f'{metric}_mean', f'{SAMPLE_PREFIX if sampled else ""}reviews_per_product'),
+             {'hue': CATEGORY, 'ylabel': f'Reviews per Product{" (sample)" if sampled else ""}',
+              'legend_loc': 'upper left'}),
+            (bar_plot, (f'{result_dir}/Q2/category_rating_barplot.png', filtered_df, CATEGORY, metric),
+             {'yerr': f'{metric}_std', 'xticks_rotation': 90})]
+
+
+def analysis_3(data, result_dir, num_bootstrap=None):
+    """
+    Q3: Is there a relationship between price and reviews?
+    """
+    # correlation with feature aggregation per-product, e.g. average rating per product
+    product_aggregates_df = data[PRODUCT_AGGREGATES]
+    product_price_wordcount_df = get_average_metric_with_price(product_aggregates_df, REVIEW_WORD_COUNT)
+    print_correlation(product_price_wordcount_df,
+                      PRICE, f'{REVIEW_WORD_COUNT}_mean',
+                      'Price', 'Mean Review Word Count', num_bootstrap=num_bootstrap)
+
+    product_price_rating_df = get_average_metric_with_price(product_aggregates_df, RATING)
+    print_correlation(product_price_rating_df,
+                      PRICE, f'{RATING}_mean',
+                      'Price', 'Mean Rating', num_bootstrap=num_bootstrap)
+
+    # product category wise analysis
+    review_by_category_df = review_behavior_by_category(data[CATEGORY_AGGREGATES], REVIEW_WORD_COUNT)
+    top_categories = review_by_category_df[CATEGORY].tolist()
+
+    filtered_wordcount_df = product_price_wordcount_df[product_price_wordcount_df[CATEGORY].isin(top_categories)].copy()
+    filtered_wordcount_df[CATEGORY] = filtered_wordcount_df[CATEGORY].cat.remove_unused_categories()
+    filtered_rating_df = product_price_rating_df[product_price_rating_df[CATEGORY].isin(top_categories)].copy()
+    filtered_rating_df[CATEGORY] = filtered_rating_df[CATEGORY].cat.remove_unused_categories()
+
+    return [(reg_plot, (f'{result_dir}/Q3/price_wordcount_scatterplot.png', product_price_wordcount_df,
+                        PRICE, f'{REVIEW_WORD_COUNT}_mean'),
+             {'max_samples': 250}),
+            (reg_plot, (f'{result_dir}/Q3/price_rating_scatterplot.png', product_price_rating_df,
+                        PRICE, f'{RATING}_mean'),
+             {'max_samples': 250}),
+            (facet_plot, (f'{result_dir}/Q3/price_wordcount_facetplot.png', filtered_wordcount_df,
+                          PRICE, f'{REVIEW_WORD_COUNT}_mean', CATEGORY),
+             {'kind': 'scatter', 'alpha': 0.3, 'xlim': (0, 300), 'ylim': (0, 300)}),
+            (facet_plot, (f'{result_dir}/Q3/price_rating_facetplot.png', filtered_rating_df,
+                          PRICE, f'{RATING}_mean', CATEGORY),
+             {'kind': 'reg', 'alpha': 0.2, 'xlim': (0, 300), 'ylim': (2, 5)})]
+
+
+def analysis_4(data, result_dir, num_bootstrap=None):
+    """
+    Q4: How does the price of reviewed products relate to the number of reviews per reviewer?
+    """
+    reviewer_summary_df = reviewer_summary(data[REVIEWER_AGGREGATES])
+
+    return [(binned_joint_plot, (f'{result_dir}/Q4/price_numreviews_jointplot.png',
+                                 density_bins(reviewer_summary_df[f'{PRICE}_mean'],
+                                              reviewer_summary_df['Number of Reviews'])),
+             {})]
+
+
+def analysis_5(data, result_dir, num_bootstrap=None):
+    """
+    Q5: How do ratings of products bought together relate to each other?
+    """
+    rating_pair_df = sample_products_bought_together(data[PRODUCT_AGGREGATES], data[METADATA_CACHE],
+                                                     num_samples=1000)
+    print(tabulate(rating_pair_df.head(10), headers='keys', tablefmt='psql'))
+
+    print_correlation(rating_pair_df, 'Rating_1', 'Rating_2', 'Rating_1', 'Rating_2', num_bootstrap=num_bootstrap)
+
+    # exact statistics over all products bought together
+    neighborhood_df, (rating_assortativity, num_pairs) = bought_together_neighborhoods(
+        data[PRODUCT_AGGREGATES], data[GRAPH_CACHE], data[PRODUCT_INDEX_CACHE])
+    print(f"Rating assortativity over all {num_pairs} rated pairs = {round(100 * rating_assortativity, 1)}%")
+    print_correlation(neighborhood_df, f'{RATING}_mean', f'{BOUGHT_TOGETHER_RATING}_mean',
+                      "product rating", "mean rating of products bought together", num_bootstrap=num_bootstrap)
+    neighborhood_by_rating_df = neighborhood_df.groupby(neighborhood_df[f'{RATING}_mean'].round()).agg(
+        **{'numProducts': (f'{RATING}_mean', 'size'),
+           f'{NUM_BOUGHT_TOGETHER}_mean': (NUM_BOUGHT_TOGETHER, 'mean'),
+           f'{BOUGHT_TOGETHER_RATING}_mean': (f'{BOUGHT_TOGETHER_RATING}_mean', 'mean')})
+    print(tabulate(neighborhood_by_rating_df, headers='keys', tablefmt='psql', floatfmt=('.0f', '.0f', '.2f', '.2f')))
+
+    return [(joint_plot, (f'{result_dir}/Q5/products_bought_together_jointplot.png', rating_pair_df,
+                          'Rating_1', 'Rating_2'),
+             {'max_samples': 1000, 'alpha': 0.25}),
+            (binned_joint_plot, (f'{result_dir}/Q5/rating_bought_together_rating_jointplot.png',
+                                 density_bins(neighborhood_df[f'{RATING}_mean'],
+                                              neighborhood_df[f'{BOUGHT_TOGETHER_RATING}_mean'])),
+             {}),
+            (plot_binned_histogram, (f'{result_dir}/Q5/num_bought_together_histogram.png',
+                                     histogram_bins(neighborhood_df[NUM_BOUGHT_TOGETHER])),
+             {'log': True})]
+
+
+def analysis_6(data, result_dir, num_bootstrap=None):
+    """
+    Q6: How do reviews change over time?
+    """
+    year_product_aggregates_df = data[YEAR_PRODUCT_AGGREGATES]
+
+    # trends over all products, rolled up from (year, month, product) aggregates
+    month_df = period_trend(data[MONTH_PRODUCT_AGGREGATES], MONTH)
+    print(tabulate(period_trend(data[MONTH_PRODUCT_AGGREGATES], YEAR), headers='keys', tablefmt='psql',
+                   showindex=False, floatfmt=('.0f', '.0f', '.2f', '.1f', '.2f')))
+
+    plot_tasks = []
+    for metric, name in [(REVIEW_WORD_COUNT, 'wordcount'), (RATING, 'rating'), (HELPFULNESS, 'helpfulness')]:
+        density_df = density_bins(year_product_aggregates_df[YEAR],
+                                  aggregate_mean(year_product_aggregates_df, metric).rename(metric))
+        plot_tasks.append((binned_joint_plot, (f'{result_dir}/Q6/year_{name}_jointplot.png', density_df), {}))
+        plot_tasks.append((line_plot, (f'{result_dir}/Q6/month_{name}_lineplot.png', month_df,
+                                       'period', f'{metric}_mean'),
+                           {'xlabel': 'Month'}))
+    return plot_tasks
+
+
+ANALYSES = {1: analysis_1,
+            2: analysis_2,
+            3: analysis_3,
+            4: analysis_4,
+            5: analysis_5,
+            6: analysis_6}
+
+
+def _init_plot_worker(profile=False):
+    """
+    Render plots without a display in worker processes
+    """
+    matplotlib.use('Agg')
+    enable_profiling(profile)
+    # forked workers start with a copy of the stages recorded by the parent
+    pop_profile_records()
+
+
+def _render_plot(plot_task):
+    """
+    Render a single plot task -> (plot function, args, kwargs)
+    """
+    plot_function, plot_args, plot_kwargs = plot_task
+    filename, df = plot_args[0], plot_args[1]
+    with profile_stage(f'plot:{os.path.basename(filename)}') as stage:
+        plot_function(*plot_args, **plot_kwargs)
+        stage['rows'] = len(df.index)
+
+
+def _render_plot_in_worker(plot_task):
+    """
+    Render a single plot task in a worker process and return the stages it recorded
+    """
+    _render_plot(plot_task)
+    return pop_profile_records()
+
+
+def render_plots(plot_tasks, num_workers=1):
+    """
+    Render plot tasks, in parallel across a pool of worker processes if num_workers > 1
+    """
+    if num_workers <= 1:
+        for plot_task in plot_tasks:
+            _render_plot(plot_task)
+        return
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_plot_worker,
+                             initargs=(is_profiling_enabled(),)) as executor:
+        for records in executor.map(_render_plot_in_worker, plot_tasks):
+            add_profile_records(records)
 
 
 if __name__ == '__main__':
@@ -98,168 +463,165 @@ if __name__ == '__main__':
     parser.add_argument('--no-preload', dest='preload', action='store_false',
                         help='Pre-process raw data')
     parser.set_defaults(preload=True)
-    parser.add_argument('--analysis_type', type=int, nargs='?',
-                        default=1,
-                        help='Question number?')
+    parser.add_argument('--load_all_data', action='store_true',
+                        help='Pre-process all review categories instead of clothing only')
+    parser.add_argument('--chunksize', type=int, nargs='?', default=None,
+                        help='Pre-process raw data in streaming mode, this many rows at a time, and build aggregates '
+                             'with the partitioned backend unless --backend is given')
+    parser.add_argument('--analysis_type', type=str, nargs='+',
+                        default=['1'],
+                        help='Question number(s), or all')
+    parser.add_argument('--append_reviews', type=str, nargs='+', default=None,
+                        help='Review dump file(s) whose new reviews are added to the pre-processed data')
+    parser.add_argument('--profile', type=str, nargs='?', const='profile.json', default=None,
+                        help='Record time, memory and rows of every pipeline stage and save them to this JSON or CSV file')
+    parser.add_argument('--num_workers', type=int, nargs='?', default=os.cpu_count(),
+                        help='Number of processes used to parse raw reviews, render plots and build partitioned aggregates')
+    parser.add_argument('--backend', type=str, nargs='?', default=None, choices=['pandas', 'partitioned'],
+                        help='Build aggregates in memory (pandas) or out-of-core across processes (partitioned), '
+                             'by default partitioned with --chunksize and pandas otherwise')
+    parser.add_argument('--num_partitions', type=int, nargs='?', default=DEFAULT_NUM_PARTITIONS,
+                        help='Number of partitions of the review data with --backend partitioned')
+    parser.add_argument('--approx', type=float, nargs='?', const=DEFAULT_SAMPLE_FRACTION, default=None,
+                        help='Exploratory run on a sample of this fraction of the reviews, stratified by product '
+                             'category and rating, with bootstrap confidence intervals')
+    parser.add_argument('--memoize', dest='memoize', action='store_true',
+                        help='Reuse analysis results computed from the same pre-processed data')
+    parser.add_argument('--no-memoize', dest='memoize', action='store_false',
+                        help='Recompute all analysis results')
+    parser.set_defaults(memoize=True)
+    parser.add_argument('--memo_size_mb', type=int, nargs='?', default=DEFAULT_MEMO_SIZE_MB,
+                        help='Size limit of memoized analysis results, least recently used results are removed first')
+    parser.add_argument('--text_store', action='store_true',
+                        help='Also save the raw review text and summaries, memory mapped, with the pre-processed data')
+    parser.add_argument('--years', type=int, nargs=2, default=None, metavar=('FIRST', 'LAST'),
+                        help='Restrict the analysis of reviews over time (Q6) to this range of years')
     args = parser.parse_args()
+    if args.approx is not None and args.append_reviews is not None:
+        parser.error('--append_reviews cannot be used with --approx')
+    if args.approx is not None and args.chunksize is not None:
+        parser.error('--chunksize cannot be used with --approx, sampled data is processed in memory')
+
+    if args.backend is None:
+        # streaming pre-processing keeps memory bounded when building aggregates too
+        args.backend = 'partitioned' if args.chunksize is not None else 'pandas'
 
     DATA_DIR = args.data_dir
     RESULT_DIR = args.result_dir
-
-    analysis_type = args.analysis_type
-    assert analysis_type in [1, 2, 3, 4, 5, 6]
-
-    if args.preload:
-        # load dataframes from existing CSVs
-        review_df = pd.read_csv('data/review_df.csv')
-        review_metadata_df = pd.read_csv('data/review_metadata_df.csv')
+    CACHE_DIR = os.path.join(DATA_DIR, CACHE_DIR_NAME)
+    num_bootstrap = None
+    if args.approx is not None:
+        # sampled data is cached separately from the full data
+        CACHE_DIR = f'{CACHE_DIR}_approx{args.approx:g}'
+        num_bootstrap = NUM_BOOTSTRAP
+    load_data.DATA_DIR = DATA_DIR
+    matplotlib.use('Agg')
+    enable_profiling(args.profile is not None)
+    enable_memoization(CACHE_DIR if args.memoize else None, max_size_mb=args.memo_size_mb)
+
+    if args.analysis_type == ['all']:
+        analysis_types = ANALYSIS_TYPES
     else:
-        # load and process data and save to CSVs
-        review_df, review_metadata_df = load_review_data(load_all_data=False)
-        review_df.to_csv('data/review_df.csv')
-        review_metadata_df.to_csv('data/review_metadata_df.csv')
-
-    joined_df = review_df.set_index(PRODUCT_ID).join(review_metadata_df.set_index(PRODUCT_ID),
-                                                     lsuffix='', rsuffix='_right').reset_index()
-
-    if analysis_type == 1:
-        # Q1: What is the relation between the reviews and the helpfulness?
-        plot_histogram(f'{RESULT_DIR}/Q1/helpfulness_histogram.png', review_df, HELPFULNESS)
-        plot_histogram(f'{RESULT_DIR}/Q1/num_helpful_histogram.png', review_df, NUM_HELPFUL, log=True,
-                       max_samples=10000)
-        plot_histogram(f'{RESULT_DIR}/Q1/num_unhelpful_histogram.png', review_df, NUM_UNHELPFUL, log=True,
-                       max_samples=10000, bins=100)
-
-        joint_plot(f'{RESULT_DIR}/Q1/wordcount_helpfulness_joint.png', review_df, REVIEW_WORD_COUNT, HELPFULNESS,
-                   alpha=0.25, max_samples=10000)
-        joint_plot(f'{RESULT_DIR}/Q1/rating_helpfulness_joint.png', review_df, RATING, HELPFULNESS,
-                   max_samples=10000, alpha=0.25)
-
-        print_correlation(review_df, HELPFULNESS, RATING, "helpfulness", "rating")
-        print_correlation(review_df, HELPFULNESS, REVIEW_WORD_COUNT, "helpfulness", "review word count")
-        print_correlation(review_df, HELPFULNESS, SUMMARY_LENGTH, "helpfulness", "summary length")
-
-        sns.barplot(x=RATING, y=HELPFULNESS, data=review_df, ci='sd', capsize=.2)
-        plt.xlabel(get_label(RATING))
-        plt.ylabel(get_label(HELPFULNESS))
-        plt.savefig(f'{RESULT_DIR}/Q1/rating_helpfulness_barplot.png', bbox_inches='tight')
-        plt.close()
-
-        joint_plot(f'{RESULT_DIR}/Q1/helpfulness_rating_jointplot.png', review_df, HELPFULNESS, RATING,
-                   max_samples=10000, alpha=0.25)
-
-    elif analysis_type == 2:
-        # Q2: What is the review behavior among different categories?
-        metric = RATING
-        review_by_category_df = review_behavior_by_category(joined_df, metric)
-        g = sns.scatterplot(f'{metric}_mean',
-                        'reviews_per_product',
-                        data=review_by_category_df,
-                        hue=CATEGORY)
-        plt.xlabel(get_label(f'{metric}_mean'))
-        plt.ylabel(get_label('Reviews per Product'))
-        plt.legend(loc='upper left')
-        plt.savefig(f'{RESULT_DIR}/Q2/rating_numreviews_scatterplot.png', bbox_inches='tight')
-        plt.close()
-
-
-        print(tabulate(review_by_category_df, headers='keys', tablefmt='psql'))
-
-        top_categories = review_by_category_df[CATEGORY].tolist()
-        filtered_df = joined_df[joined_df[CATEGORY].isin(top_categories)]
-        sns.barplot(CATEGORY, metric, data=filtered_df, ci='sd', capsize=.2)
-        plt.xlabel(get_label(CATEGORY))
-        plt.ylabel(get_label(metric))
-        plt.xticks(rotation=90)
-        plt.savefig(f'{RESULT_DIR}/Q2/category_rating_barplot.png', bbox_inches='tight')
-        plt.close()
-
-    elif analysis_type == 3:
-        # Q3: Is there a relationship between price and reviews?
-
-        # correlation with feature aggregation per-product, e.g. average rating per product
-        product_price_wordcount_df = get_average_metric_with_price(review_df, review_metadata_df, REVIEW_WORD_COUNT)
-        print_correlation(product_price_wordcount_df,
-                          PRICE, f'{REVIEW_WORD_COUNT}_mean',
-                          'Price', 'Mean Review Word Count')
-        g = sns.regplot(data=product_price_wordcount_df.sample(250), x=PRICE, y=f'{REVIEW_WORD_COUNT}_mean', marker='+',
-                    scatter_kws={'alpha': 0.4})
-        plt.xlabel(get_label(PRICE))
-        plt.ylabel(get_label(f'{REVIEW_WORD_COUNT}_mean'))
-        plt.savefig(f'{RESULT_DIR}/Q3/price_wordcount_scatterplot.png', bbox_inches='tight')
-        plt.close()
-
-        product_price_rating_df = get_average_metric_with_price(review_df, review_metadata_df, RATING)
-        print_correlation(product_price_rating_df,
-                          PRICE, f'{RATING}_mean',
-                          'Price', 'Mean Rating')
-        g = sns.regplot(data=product_price_rating_df.sample(250), x=PRICE, y=f'{RATING}_mean', marker='+',
-                    scatter_kws={'alpha': 0.4})
-        plt.xlabel(get_label(PRICE))
-        plt.ylabel(get_label(f'{RATING}_mean'))
-        plt.savefig(f'{RESULT_DIR}/Q3/price_rating_scatterplot.png', bbox_inches='tight')
-        plt.close()
-
-        # product category wise analysis
-        review_by_category_df = review_behavior_by_category(joined_df, REVIEW_WORD_COUNT)
-        top_categories = review_by_category_df[CATEGORY].tolist()
-
-        # price_wordcount_facetplot
-        filtered_df = product_price_wordcount_df[product_price_wordcount_df[CATEGORY].isin(top_categories)]
-        g = sns.FacetGrid(filtered_df, col=CATEGORY, height=5, col_wrap=2)
-        g.map(sns.scatterplot, PRICE, f'{REVIEW_WORD_COUNT}_mean', marker='+', alpha=0.3)
-        g.set_axis_labels(get_label(PRICE), get_label(f'{REVIEW_WORD_COUNT}_mean'))
-        plt.xlim(0, 300)
-        plt.ylim(0, 300)
-        plt.savefig(f'{RESULT_DIR}/Q3/price_wordcount_facetplot.png', bbox_inches='tight')
-        plt.close()
-
-        # price_rating_facetplot
-        filtered_df = product_price_rating_df[product_price_rating_df[CATEGORY].isin(top_categories)]
-        g = sns.FacetGrid(filtered_df, col=CATEGORY, height=5, col_wrap=2)
-        g.map(sns.regplot, PRICE, f'{RATING}_mean', marker='+', scatter_kws={'alpha': 0.2})
-        # plt.xlabel(get_label(PRICE))
-        # plt.ylabel(get_label(f'{RATING}_mean'))
-        g.set_axis_labels(get_label(PRICE), get_label(f'{RATING}_mean'))
-        plt.xlim(0, 300)
-        plt.ylim(2, 5)
-        plt.savefig(f'{RESULT_DIR}/Q3/price_rating_facetplot.png', bbox_inches='tight')
-        plt.close()
-
-    elif analysis_type == 4:
-        reviewer_summary_df = joined_df.groupby([REVIEWER_ID, REVIEWER_NAME]) \
-            .agg({PRICE: ['mean'], PRODUCT_ID: ['count']})
-
-        reviewer_summary_df.columns = ["_".join(x) for x in reviewer_summary_df.columns.ravel()]
-        reviewer_summary_df['Number of Reviews'] = reviewer_summary_df[f'{PRODUCT_ID}_count']
-        joint_plot(f'{RESULT_DIR}/Q4/price_numreviews_jointplot.png', reviewer_summary_df,
-                   f'{PRICE}_mean', 'Number of Reviews', max_samples=500, alpha=0.6)
-
-    elif analysis_type == 5:
-        rating_pair_df = sample_products_bought_together(review_df, review_metadata_df, num_samples=1000)
-        print(tabulate(rating_pair_df.head(10), headers='keys', tablefmt='psql'))
-
-        print_correlation(rating_pair_df, 'Rating_1', 'Rating_2', 'Rating_1', 'Rating_2')
-
-        joint_plot(f'{RESULT_DIR}/Q5/products_bought_together_jointplot.png', rating_pair_df, 'Rating_1', 'Rating_2', max_samples=1000, alpha=0.25)
-
-    elif analysis_type == 6:
-        YEAR = 'year'
-        time_joined_df = review_df.set_index(PRODUCT_ID).join(review_metadata_df.set_index(PRODUCT_ID),
-                                                              lsuffix='', rsuffix='_right').reset_index()
-
-        metric = REVIEW_WORD_COUNT
-        rating_df = time_joined_df[[YEAR, PRODUCT_ID, metric]].groupby([YEAR, PRODUCT_ID]).mean(metric).reset_index()
-        joint_plot(f'{RESULT_DIR}/Q6/year_wordcount_jointplot.png', rating_df, YEAR, metric, alpha=0.75, max_samples=10000)
-        plt.ylim(0, 600)
-        plt.close()
-
-        metric = RATING
-        rating_df = time_joined_df[[YEAR, PRODUCT_ID, metric]].groupby([YEAR, PRODUCT_ID]).mean(metric).reset_index()
-        joint_plot(f'{RESULT_DIR}/Q6/year_rating_jointplot.png', rating_df, YEAR, metric, alpha=0.75, max_samples=10000)
-        plt.close()
-
-        metric = HELPFULNESS
-        rating_df = time_joined_df[[YEAR, PRODUCT_ID, metric]].groupby([YEAR, PRODUCT_ID]).mean(metric).reset_index()
-        joint_plot(f'{RESULT_DIR}/Q6/year_helpfulness_jointplot.png', rating_df, YEAR, metric, alpha=0.75, max_samples=10000)
-        plt.close()
\ No newline at end of file
+        analysis_types = [int(analysis_type) for analysis_type in args.analysis_type]
+    assert all(analysis_type in ANALYSIS_TYPES for analysis_type in analysis_types)
+
+    review_files, metadata_files = review_data_files(load_all_data=args.load_all_data)
+    source_files = review_files + metadata_files
+    rebuild = not (args.preload
+                   and is_cache_valid(CACHE_DIR, REVIEW_CACHE, review_files)
+                   and is_cache_valid(CACHE_DIR, METADATA_CACHE, metadata_files)
+                   and is_cache_valid(CACHE_DIR, PRODUCT_INDEX_CACHE, metadata_files))
+    rebuild_text_store = args.text_store and not is_text_store_valid(CACHE_DIR, review_files)
+    if rebuild_text_store and args.approx is not None:
+        # the texts of a sample are only known by sampling again
+        rebuild = True
+    appended_files = appended_source_files(CACHE_DIR, REVIEW_CACHE)
+    if rebuild:
+        # a rebuild only keeps reviews appended from dumps given again with --append_reviews
+        dropped_files = sorted(set(appended_files) - set(map(os.path.abspath, args.append_reviews or [])))
+        if dropped_files:
+            parser.error(f'rebuilding the cache would drop the reviews appended from {", ".join(dropped_files)}, '
+                         f'add them with --append_reviews or remove {CACHE_DIR}')
+    elif rebuild_text_store:
+        # the review cache is up to date, only the raw text is read again
+        if appended_files:
+            parser.error(f'the text store does not have the texts of the reviews appended from '
+                         f'{", ".join(appended_files)}, rebuild the cache with --no-preload --text_store '
+                         f'--append_reviews {" ".join(appended_files)}')
+        with profile_stage('build_text_store'):
+            clear_text_store(CACHE_DIR)
+            save_review_texts(text_store_dir(CACHE_DIR), load_all_data=args.load_all_data)
+            save_text_store(CACHE_DIR, review_files)
+    if rebuild:
+        # load and process raw data and save to the cache, the cache is rebuilt
+        # whenever it is missing or the raw data files have changed
+        text_store = None
+        if args.text_store:
+            clear_text_store(CACHE_DIR)
+            text_store = text_store_dir(CACHE_DIR)
+        with profile_stage('preprocess'):
+            if args.approx is not None:
+                # sampled data fits in memory
+                review_df, review_metadata_df = load_review_data(load_all_data=args.load_all_data,
+                                                                 sample_fraction=args.approx, random_state=0,
+                                                                 text_store=text_store)
+                review_chunks, metadata_chunks = [review_df], [review_metadata_df]
+            elif args.chunksize is not None:
+                # process data chunk by chunk
+                review_chunks, metadata_chunks = iter_review_data(load_all_data=args.load_all_data,
+                                                                  chunksize=args.chunksize, text_store=text_store)
+            else:
+                review_df, review_metadata_df = load_review_data(load_all_data=args.load_all_data,
+                                                                 num_workers=args.num_workers, text_store=text_store)
+                review_chunks, metadata_chunks = [review_df], [review_metadata_df]
+            save_cache(CACHE_DIR, METADATA_CACHE, metadata_chunks, metadata_files)
+            product_index = save_product_index(CACHE_DIR, metadata_files)
+            save_bought_together_graph(CACHE_DIR, metadata_files)
+            # moments of the reviews are accumulated while they are written to the cache
+            moments = empty_moments()
+            review_chunks = accumulate_moments(review_chunks, moments,
+                                               load_cache(CACHE_DIR, METADATA_CACHE, columns=[PRICE]), product_index)
+            save_cache(CACHE_DIR, REVIEW_CACHE, review_chunks, review_files, appended_sources=appended_files)
+            save_moments(CACHE_DIR, moments, source_files)
+            if text_store is not None:
+                save_text_store(CACHE_DIR, review_files)
+
+    # the co-purchase graph and moments are computed from the cache if it was built without them
+    if not is_cache_valid(CACHE_DIR, GRAPH_CACHE, metadata_files):
+        save_bought_together_graph(CACHE_DIR, metadata_files)
+    if not is_cache_valid(CACHE_DIR, MOMENTS_CACHE, source_files):
+        save_moments(CACHE_DIR, compute_review_moments(CACHE_DIR, chunksize=args.chunksize or DEFAULT_CHUNKSIZE),
+                     source_files)
+
+    # aggregates are rebuilt together with the preprocessed data
+    if rebuild or not is_aggregate_store_valid(CACHE_DIR, source_files):
+        with profile_stage('build_aggregates'):
+            if args.backend == 'partitioned':
+                aggregate_store = build_aggregate_store_partitioned(
+                    CACHE_DIR, num_partitions=args.num_partitions, num_workers=args.num_workers,
+                    chunksize=args.chunksize or DEFAULT_CHUNKSIZE)
+            else:
+                aggregate_store = build_aggregate_store(
+                    load_cache(CACHE_DIR, REVIEW_CACHE, columns=AGGREGATE_REVIEW_COLUMNS),
+                    load_cache(CACHE_DIR, METADATA_CACHE, columns=AGGREGATE_METADATA_COLUMNS),
+                    product_index=load_product_index(CACHE_DIR))
+            save_aggregate_store(CACHE_DIR, aggregate_store, source_files)
+
+    if args.append_reviews is not None:
+        with profile_stage('ingest_new_reviews') as stage:
+            num_new_reviews = ingest_new_reviews(CACHE_DIR, args.append_reviews, source_files, review_files)
+            stage['rows'] = num_new_reviews
+        print(f'Added {num_new_reviews} new reviews')
+
+    # compute all tables first, then render all plots
+    with profile_stage('load_analysis_data'):
+        data = load_analysis_data(CACHE_DIR, analysis_types, bootstrap=num_bootstrap is not None, years=args.years)
+    plot_tasks = []
+    for analysis_type in analysis_types:
+        with profile_stage(f'analysis_{analysis_type}'):
+            plot_tasks.extend(ANALYSES[analysis_type](data, RESULT_DIR, num_bootstrap=num_bootstrap))
+    with profile_stage('render_plots'):
+        render_plots(plot_tasks, num_workers=args.num_workers)
+
+    if args.profile is not None:
+        write_profile_report(args.profile)
@@ -0,0 +1,272 @@
+import argparse
+import functools
+import glob
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import time
+import pandas as pd
+from tabulate import tabulate
+
+from cache import *
+from aggregates import AGGREGATE_LEVELS
+from profiling import profile_stage
+
+MEMO_DIR_NAME = 'memo'
+DEFAULT_MEMO_SIZE_MB = 256
+# folder of the analysis modules, functions defined there are hashed with the memoized functions calling them
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# memoization state of the current process, results are only memoized when a cache folder is set
+_MEMO = {'cache_dir': None,
+         'max_bytes': DEFAULT_MEMO_SIZE_MB * 2 ** 20}
+
+
+def enable_memoization(cache_dir, max_size_mb=DEFAULT_MEMO_SIZE_MB):
+    """
+    Memoize results of decorated functions next to the pre-processed data in cache_dir,
+    keeping at most max_size_mb of results. Pass cache_dir=None to turn memoization off
+    """
+    _MEMO['cache_dir'] = cache_dir
+    _MEMO['max_bytes'] = max_size_mb * 2 ** 20
+
+
+def _memo_dir(cache_dir):
+    """
+    Folder of memoized results of a cache folder
+    """
+    return os.path.join(cache_dir, MEMO_DIR_NAME)
+
+
+def _input_fingerprint(cache_dir, inputs):
+    """
+    Identify the current version of cache entries by name, size and modification time of their data
+    files, these change whenever an entry is rebuilt or appended to
+    """
+    fingerprint = []
+    for name in inputs:
+        # levels of the aggregate store are saved as aggregates_{level}
+        if name in AGGREGATE_LEVELS:
+            name = f'aggregates_{name}'
+        for filename in cache_files(cache_dir, name):
+            stat = os.stat(filename)
+            fingerprint.append([os.path.basename(filename), stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+
+def _argument_key(value):
+    """
+    Hashable description of an argument. Dataframes are described by their shape, columns and types,
+    their data is identified by the fingerprint of the cache entries they were loaded from
+    """
+    if isinstance(value, pd.DataFrame):
+        return ['DataFrame', list(value.shape), [str(column) for column in value.columns],
+                [str(dtype) for dtype in value.dtypes]]
+    if isinstance(value, pd.Series):
+        return ['Series', len(value.index), str(value.name), str(value.dtype)]
+    if isinstance(value, (list, tuple)):
+        return [_argument_key(item) for item in value]
+    if isinstance(value, dict):
+        return [[str(key), _argument_key(item)] for key, item in sorted(value.items())]
+    return repr(value)
+
+
+def _constant_key(value):
+    """
+    Description of a constant of compiled code which does not depend on the order of sets
+    """
+    if isinstance(value, frozenset):
+        return repr(sorted(map(_constant_key, value)))
+    return repr(value)
+
+
+def _code_names(code):
+    """
+    Global or attribute names used by compiled code, including nested functions and comprehensions
+    """
+    names = set(code.co_names)
+    for constant in code.co_consts:
+        if inspect.iscode(constant):
+            names |= _code_names(constant)
+    return names
+
+
+def _update_code_hash(hasher, code):
+    """
+    Add the instructions, constants and names of compiled code to a hash, including nested code
+    """
+    hasher.update(code.co_code)
+    for constant in code.co_consts:
+        if inspect.iscode(constant):
+            _update_code_hash(hasher, constant)
+        else:
+            hasher.update(_constant_key(constant).encode())
+    hasher.update(' '.join(code.co_names).encode())
+
+
+def _code_fingerprint(func):
+    """
+    Hash of the code of a function, of the functions of the analysis modules (SOURCE_DIR) it uses,
+    directly or through other functions, and of the scalar module constants they use. Changing a helper
+    such as aggregate_mean changes the fingerprint of every memoized function using it
+    """
+    hasher = hashlib.sha1()
+    pending, seen = [func], set()
+    while pending:
+        func = inspect.unwrap(pending.pop())
+        if func in seen:
+            continue
+        seen.add(func)
+        _update_code_hash(hasher, func.__code__)
+        for name in sorted(_code_names(func.__code__)):
+            value = func.__globals__.get(name)
+            if inspect.isfunction(value) and os.path.dirname(os.path.abspath(inspect.getfile(value))) == SOURCE_DIR:
+                pending.append(value)
+            elif isinstance(value, (str, int, float, bool)):
+                hasher.update(f'{name}={value!r}'.encode())
+    return hasher.hexdigest()
+
+
+def _entry_paths(cache_dir, key):
+    """
+    Paths of the pickled result and the description of a memoized entry
+    """
+    path = os.path.join(_memo_dir(cache_dir), key)
+    return f'{path}.pkl', f'{path}.json'
+
+
+def _evict(cache_dir, max_bytes):
+    """
+    Remove least recently used entries until results take at most max_bytes
+    """
+    result_paths = glob.glob(os.path.join(_memo_dir(cache_dir), '*.pkl'))
+    # the modification time of results is updated whenever they are used
+    entries = sorted((os.stat(path).st_mtime, os.stat(path).st_size, path) for path in result_paths)
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total_bytes <= max_bytes:
+            break
+        os.remove(path)
+        os.remove(f'{path[:-len(".pkl")]}.json')
+        total_bytes -= size
+
+
+def memoize(*inputs):
+    """
+    Memoize the results of a function on disk, keyed by
+    - function name, and code of the function and of the helpers it uses (see _code_fingerprint)
+    - arguments, with defaults applied
+    - fingerprint of the cache entries or aggregate levels (e.g. REVIEW_CACHE, PRODUCT_AGGREGATES)
+      its data comes from
+    Results are kept in the cache folder set by enable_memoization, least recently used results are
+    evicted beyond its size limit. Results must be picklable, dataframe arguments must be
+    cache entries as loaded since their content is not hashed
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        # helpers may be defined after the decorated function, the code is hashed on first use
+        code = {}
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cache_dir = _MEMO['cache_dir']
+            if cache_dir is None:
+                return func(*args, **kwargs)
+
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            description = {'function': func.__qualname__,
+                           'arguments': {name: _argument_key(value) for name, value in arguments.arguments.items()},
+                           'inputs': _input_fingerprint(cache_dir, inputs)}
+            if 'fingerprint' not in code:
+                code['fingerprint'] = _code_fingerprint(func)
+            key_data = json.dumps([description, code['fingerprint']], sort_keys=True)
+            key = f'{func.__name__}-{hashlib.sha1(key_data.encode()).hexdigest()}'
+            result_path, description_path = _entry_paths(cache_dir, key)
+
+            if os.path.exists(result_path):
+                with profile_stage(f'memo_hit:{func.__name__}'):
+                    with open(result_path, 'rb') as f:
+                        result = pickle.load(f)
+                os.utime(result_path)
+                return result
+
+            result = func(*args, **kwargs)
+            os.makedirs(_memo_dir(cache_dir), exist_ok=True)
+            # written to a temporary file first so that interrupted runs leave no partial entries
+            with open(f'{result_path}.tmp', 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            with open(description_path, 'w') as f:
+                json.dump({**description, 'created': time.time()}, f)
+            os.replace(f'{result_path}.tmp', result_path)
+            _evict(cache_dir, _MEMO['max_bytes'])
+            return result
+        return wrapper
+    return decorator
+
+
+def _format_arguments(arguments):
+    """
+    Short display of memoized arguments, dataframes are shown by type and shape
+    """
+    formatted = []
+    for name, key in arguments.items():
+        if isinstance(key, list) and key and key[0] == 'DataFrame':
+            key = f'DataFrame({key[1][0]}x{key[1][1]})'
+        elif isinstance(key, list) and key and key[0] == 'Series':
+            key = f'Series({key[1]})'
+        formatted.append(f'{name}={key}')
+    return ', '.join(formatted)
+
+
+def list_memoized(cache_dir):
+    """
+    Description of every memoized result, most recently used first
+    """
+    records = []
+    for result_path in glob.glob(os.path.join(_memo_dir(cache_dir), '*.pkl')):
+        key = os.path.basename(result_path)[:-len('.pkl')]
+        with open(_entry_paths(cache_dir, key)[1]) as f:
+            description = json.load(f)
+        stat = os.stat(result_path)
+        records.append({'key': key,
+                        'function': description['function'],
+                        'arguments': _format_arguments(description['arguments']),
+                        'size_kb': stat.st_size / 1024,
+                        'created': pd.Timestamp(description['created'], unit='s').floor('s'),
+                        'last_used': pd.Timestamp(stat.st_mtime, unit='s').floor('s')})
+    return pd.DataFrame(records, columns=['key', 'function', 'arguments', 'size_kb', 'created', 'last_used']) \
+        .sort_values('last_used', ascending=False)
+
+
+def clear_memoized(cache_dir, function=None):
+    """
+    Remove all memoized results, or only those of a function. Returns the number of results removed
+    """
+    memoized_df = list_memoized(cache_dir)
+    if function is not None:
+        memoized_df = memoized_df[memoized_df['function'] == function]
+    for key in memoized_df['key']:
+        for path in _entry_paths(cache_dir, key):
+            os.remove(path)
+    return len(memoized_df.index)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', type=str, choices=['list', 'clear'],
+                        help='List or remove memoized analysis results')
+    parser.add_argument('--cache_dir', type=str, nargs='?', default=os.path.join('data', CACHE_DIR_NAME),
+                        help='Pre-processed data folder the results were memoized in')
+    parser.add_argument('--function', type=str, nargs='?', default=None,
+                        help='Only remove results of this function')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        memoized_df = list_memoized(args.cache_dir)
+        print(tabulate(memoized_df, headers='keys', tablefmt='psql', showindex=False, floatfmt='.1f'))
+        print(f'{len(memoized_df.index)} results, {memoized_df["size_kb"].sum() / 1024:.1f} MB')
+    else:
+        print(f'Removed {clear_memoized(args.cache_dir, function=args.function)} results')
@@ -0,0 +1,149 @@
+import itertools
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from load_data import *
+from cache import *
+from product_index import *
+from profiling import profile_stage
+
+MOMENTS_CACHE = 'review_moments'
+
+# columns of the review data (and price of the reviewed product) whose correlations are accumulated
+MOMENT_COLUMNS = [HELPFULNESS, RATING, REVIEW_WORD_COUNT, SUMMARY_LENGTH, PRICE, NUM_HELPFUL, NUM_UNHELPFUL]
+MOMENT_REVIEW_COLUMNS = [PRODUCT_ID] + [column for column in MOMENT_COLUMNS if column != PRICE]
+
+# mergeable statistics of every (column_1, column_2) pair, over the rows where both are present
+# - count : # of rows
+# - mean : mean of column_1
+# - m2 : sum of squared deviations of column_1 from its mean
+# - comoment : sum of products of deviations of column_1 and column_2 from their means
+MOMENT_STATISTICS = ['count', 'mean', 'm2', 'comoment']
+COLUMN_1 = 'column_1'
+COLUMN_2 = 'column_2'
+
+
+def empty_moments(columns=MOMENT_COLUMNS):
+    """
+    Moments of no rows, the identity of merge_moments
+    """
+    moments = {statistic: np.zeros((len(columns), len(columns))) for statistic in MOMENT_STATISTICS}
+    moments['columns'] = list(columns)
+    return moments
+
+
+def chunk_moments(df, columns=MOMENT_COLUMNS):
+    """
+    Moments of the columns of a dataframe, for every pair of columns over the rows where both
+    are present (as Series.corr). Values are centred on the column means of the chunk first
+    so that sums of squares do not lose precision
+    """
+    values = df[columns].to_numpy(dtype=float)
+    valid = ~np.isnan(values)
+    weights = valid.astype(float)
+    num_valid = weights.sum(axis=0)
+    shift = np.where(valid, values, 0).sum(axis=0) / np.maximum(num_valid, 1)
+    centred = np.where(valid, values - shift, 0)
+
+    count = weights.T @ weights
+    # sums[i, j] : sum of column i over the rows where column j is present
+    sums = centred.T @ weights
+    mean = np.divide(sums, count, out=np.zeros_like(sums), where=count > 0)
+    return {'count': count,
+            'mean': mean + shift[:, np.newaxis],
+            'm2': (centred ** 2).T @ weights - sums * mean,
+            'comoment': centred.T @ centred - sums * mean.T,
+            'columns': list(columns)}
+
+
+def merge_moments(moments_1, moments_2):
+    """
+    Moments of the union of the rows of 2 sets of moments (pairwise update of Chan et al.),
+    e.g. of 2 chunks or of the results of 2 workers
+    """
+    assert moments_1['columns'] == moments_2['columns']
+    count = moments_1['count'] + moments_2['count']
+    fraction_2 = np.divide(moments_2['count'], count, out=np.zeros_like(count), where=count > 0)
+    delta = moments_2['mean'] - moments_1['mean']
+    return {'count': count,
+            'mean': moments_1['mean'] + delta * fraction_2,
+            'm2': moments_1['m2'] + moments_2['m2'] + delta ** 2 * moments_1['count'] * fraction_2,
+            'comoment': moments_1['comoment'] + moments_2['comoment']
+                        + delta * delta.T * moments_1['count'] * fraction_2,
+            'columns': moments_1['columns']}
+
+
+def correlation_matrix(moments):
+    """
+    Pearson correlation of every pair of columns, missing for pairs with less than 2 rows
+    or a constant column
+    """
+    denominator = np.sqrt(moments['m2'] * moments['m2'].T)
+    valid = (moments['count'] > 1) & (denominator > 0)
+    correlation = np.divide(moments['comoment'], denominator, out=np.full_like(denominator, np.nan), where=valid)
+    return pd.DataFrame(correlation, index=moments['columns'], columns=moments['columns'])
+
+
+def review_moment_values(review_df, review_metadata_df, product_index):
+    """
+    Columns of the review data used by the moments, with the price of the reviewed product
+    looked up from the product data
+    """
+    values_df = review_df[[column for column in MOMENT_COLUMNS if column != PRICE]].copy()
+    values_df[PRICE] = take_product_columns(review_metadata_df, product_rows(review_df[PRODUCT_ID], product_index),
+                                            [PRICE])[PRICE].to_numpy()
+    return values_df
+
+
+def accumulate_moments(review_chunks, moments, review_metadata_df, product_index):
+    """
+    Pass review data chunks through unchanged, merging the moments of every chunk into moments,
+    so that they are computed while the chunks are written to the cache
+    """
+    for review_df in review_chunks:
+        moments.update(merge_moments(moments, chunk_moments(
+            review_moment_values(review_df, review_metadata_df, product_index), moments['columns'])))
+        yield review_df
+
+
+def compute_review_moments(cache_dir, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Moments of the review cache, streamed chunk by chunk
+    """
+    review_metadata_df = load_cache(cache_dir, METADATA_CACHE, columns=[PRICE])
+    product_index = load_product_index(cache_dir)
+    batches = itertools.chain.from_iterable(
+        pq.ParquetFile(filename).iter_batches(batch_size=chunksize, columns=MOMENT_REVIEW_COLUMNS)
+        for filename in cache_files(cache_dir, REVIEW_CACHE))
+
+    moments = empty_moments()
+    with profile_stage('compute_review_moments') as stage:
+        review_chunks = (pa.Table.from_batches([batch]).to_pandas() for batch in batches)
+        stage['rows'] = sum(len(review_df.index) for review_df in
+                            accumulate_moments(review_chunks, moments, review_metadata_df, product_index))
+    return moments
+
+
+def save_moments(cache_dir, moments, source_files):
+    """
+    Save moments to the cache, one row per pair of columns
+    """
+    columns = moments['columns']
+    moments_df = pd.DataFrame({COLUMN_1: pd.Categorical(np.repeat(columns, len(columns)), categories=columns),
+                               COLUMN_2: pd.Categorical(np.tile(columns, len(columns)), categories=columns),
+                               **{statistic: moments[statistic].ravel() for statistic in MOMENT_STATISTICS}})
+    save_cache(cache_dir, MOMENTS_CACHE, [moments_df], source_files)
+
+
+def load_moments(cache_dir):
+    """
+    Load moments saved with save_moments
+    """
+    moments_df = load_cache(cache_dir, MOMENTS_CACHE)
+    columns = list(pd.unique(moments_df[COLUMN_1]))
+    moments = {statistic: moments_df[statistic].to_numpy(dtype=float).reshape(len(columns), len(columns))
+               for statistic in MOMENT_STATISTICS}
+    moments['columns'] = columns
+    return moments
@@ -0,0 +1,162 @@
+import glob
+import itertools
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor
+
+from load_data import *
+from cache import *
+from cache import _to_table
+from aggregates import *
+from aggregates import _month_product_aggregates, _year_product_aggregates, _reviewer_aggregates, \
+    _product_aggregates, _category_aggregates
+from profiling import profile_stage
+
+DEFAULT_NUM_PARTITIONS = 16
+
+# columns of the preprocessed review data spilled to each kind of partition
+# - by Product ID : (year, month, product) aggregates, all reviews of a product are in one partition
+# - by reviewer : reviewer aggregates, all reviews of a reviewer are in one partition
+PRODUCT_PARTITION_COLUMNS = [PRODUCT_ID, YEAR, MONTH] + AGGREGATE_METRICS
+REVIEWER_PARTITION_COLUMNS = [REVIEWER_ID, REVIEWER_NAME, PRODUCT_ID]
+
+# product data used to aggregate reviewer partitions, loaded once per process (see _init_partition_worker)
+_PARTITION_WORKER = {'review_metadata_df': None,
+                     'product_index': None}
+
+
+def _partition_ids(values, num_partitions):
+    """
+    Partition of every value from its hash, consistent across chunks
+    """
+    return pd.util.hash_pandas_object(values, index=False).to_numpy() % num_partitions
+
+
+def _spill_partitions(df, partition_ids, num_partitions, partition_dir, chunk_index):
+    """
+    Write the rows of a chunk belonging to each partition to its own folder in partition_dir,
+    keeping the order of rows within each partition
+    """
+    order = np.argsort(partition_ids, kind='stable')
+    bounds = np.searchsorted(partition_ids[order], np.arange(num_partitions + 1))
+    for partition in range(num_partitions):
+        rows = order[bounds[partition]:bounds[partition + 1]]
+        if len(rows) == 0:
+            continue
+        path = os.path.join(partition_dir, f'{partition:04d}')
+        os.makedirs(path, exist_ok=True)
+        pq.write_table(_to_table(df.iloc[rows]), os.path.join(path, f'{chunk_index:06d}.parquet'))
+
+
+def partition_review_cache(cache_dir, spill_dir, num_partitions=DEFAULT_NUM_PARTITIONS,
+                           chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Stream the review cache chunk by chunk and spill it to disk twice, partitioned by
+    Product ID hash and by reviewer hash. Peak memory is bounded by the chunk size.
+    Returns the product and reviewer partition folders
+    """
+    product_dir = os.path.join(spill_dir, PRODUCT_AGGREGATES)
+    reviewer_dir = os.path.join(spill_dir, REVIEWER_AGGREGATES)
+    batches = itertools.chain.from_iterable(
+        pq.ParquetFile(filename).iter_batches(batch_size=chunksize, columns=AGGREGATE_REVIEW_COLUMNS)
+        for filename in cache_files(cache_dir, REVIEW_CACHE))
+
+    for chunk_index, batch in enumerate(batches):
+        review_df = pa.Table.from_batches([batch]).to_pandas()
+        _spill_partitions(review_df[PRODUCT_PARTITION_COLUMNS], _partition_ids(review_df[PRODUCT_ID], num_partitions),
+                          num_partitions, product_dir, chunk_index)
+        _spill_partitions(review_df[REVIEWER_PARTITION_COLUMNS], _partition_ids(review_df[REVIEWER_ID], num_partitions),
+                          num_partitions, reviewer_dir, chunk_index)
+    return sorted(glob.glob(os.path.join(product_dir, '*'))), sorted(glob.glob(os.path.join(reviewer_dir, '*')))
+
+
+def _read_partition(partition_path):
+    """
+    Load all chunks of a partition in the order they were written
+    """
+    tables = [pq.read_table(filename) for filename in sorted(glob.glob(os.path.join(partition_path, '*.parquet')))]
+    return pa.concat_tables(tables).to_pandas()
+
+
+def _month_product_partition(partition_path):
+    """
+    (Year, month, product) aggregates of a Product ID partition
+    """
+    return _month_product_aggregates(_read_partition(partition_path)).reset_index()
+
+
+def _init_partition_worker(cache_dir):
+    """
+    Load the product data and product index from the cache once per worker process,
+    rather than sending them with every reviewer partition
+    """
+    _PARTITION_WORKER['review_metadata_df'] = load_cache(cache_dir, METADATA_CACHE, columns=AGGREGATE_METADATA_COLUMNS)
+    _PARTITION_WORKER['product_index'] = load_product_index(cache_dir)
+
+
+def _reviewer_partition(partition_path):
+    """
+    Reviewer aggregates of a reviewer partition, with the product data of the current process
+    """
+    return _reviewer_aggregates(_read_partition(partition_path), _PARTITION_WORKER['review_metadata_df'],
+                                _PARTITION_WORKER['product_index']).reset_index()
+
+
+def _merge_partitions(partial_dfs, keys):
+    """
+    Concatenate aggregates of disjoint partitions, in the order of the pandas groupby
+    (keys sorted by value, see sorted_categories)
+    """
+    merged_df = pd.concat(partial_dfs, ignore_index=True)
+    for key in keys:
+        if not pd.api.types.is_numeric_dtype(merged_df[key]):
+            merged_df[key] = sorted_categories(merged_df[key])
+    return merged_df.sort_values(keys).set_index(keys)
+
+
+def build_aggregate_store_partitioned(cache_dir, num_partitions=DEFAULT_NUM_PARTITIONS, num_workers=1,
+                                      chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Out-of-core, multi-core counterpart of build_aggregate_store on the review cache
+    - spill the review table to disk partitioned by Product ID hash and by reviewer hash
+    - aggregate each partition in a pool of num_workers processes
+    - merge partition aggregates, each product and each reviewer is in exactly one partition
+    - derive (year, product), product and category aggregates from the merged (year, month, product) aggregates
+    Only one chunk or one partition of reviews is in memory at a time per process, product data
+    is loaded in full, once per process. Rows within a partition keep their order, so sums are computed in the
+    same order and results are identical to build_aggregate_store
+    """
+    _init_partition_worker(cache_dir)
+    review_metadata_df, product_index = _PARTITION_WORKER['review_metadata_df'], _PARTITION_WORKER['product_index']
+
+    with tempfile.TemporaryDirectory(dir=cache_dir) as spill_dir:
+        with profile_stage('partition_reviews'):
+            product_partitions, reviewer_partitions = partition_review_cache(cache_dir, spill_dir, num_partitions,
+                                                                             chunksize=chunksize)
+        with profile_stage('aggregate_partitions'):
+            if num_workers <= 1:
+                month_product_dfs = list(map(_month_product_partition, product_partitions))
+                reviewer_dfs = list(map(_reviewer_partition, reviewer_partitions))
+            else:
+                with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_partition_worker,
+                                         initargs=(cache_dir,)) as executor:
+                    # both kinds of partitions are queued at once
+                    month_product_results = executor.map(_month_product_partition, product_partitions)
+                    reviewer_results = executor.map(_reviewer_partition, reviewer_partitions)
+                    month_product_dfs, reviewer_dfs = list(month_product_results), list(reviewer_results)
+
+    with profile_stage('merge_partitions'):
+        month_product_df = _merge_partitions(month_product_dfs, [YEAR, MONTH, PRODUCT_ID])
+        year_product_df = _year_product_aggregates(month_product_df)
+        reviewer_df = _merge_partitions(reviewer_dfs, [REVIEWER_ID, REVIEWER_NAME])
+        product_df = _product_aggregates(year_product_df, review_metadata_df, product_index)
+
+    return {PRODUCT_AGGREGATES: product_df.reset_index(),
+            CATEGORY_AGGREGATES: _category_aggregates(product_df).reset_index(),
+            REVIEWER_AGGREGATES: reviewer_df.reset_index(),
+            YEAR_PRODUCT_AGGREGATES: year_product_df.reset_index(),
+            MONTH_PRODUCT_AGGREGATES: month_product_df.reset_index()}
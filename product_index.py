@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+
+from load_data import *
+from cache import *
+
+PRODUCT_INDEX_CACHE = 'product_index'
+ROW = 'row'
+
+
+def build_product_index(product_ids):
+    """
+    Product ID -> row position in the product data, the first row for repeated Product IDs
+    """
+    product_ids = pd.Series(np.asarray(product_ids, dtype=object))
+    first = ~product_ids.duplicated()
+    return pd.Series(np.flatnonzero(first.to_numpy()).astype(np.int64), index=pd.Index(product_ids[first]),
+                     name=ROW)
+
+
+def save_product_index(cache_dir, source_files):
+    """
+    Build the Product ID index of the cached product data and save it next to it
+    """
+    product_index = build_product_index(load_cache(cache_dir, METADATA_CACHE, columns=[PRODUCT_ID])[PRODUCT_ID])
+    save_cache(cache_dir, PRODUCT_INDEX_CACHE, [product_index.rename_axis(PRODUCT_ID).reset_index()], source_files)
+    return product_index
+
+
+def load_product_index(cache_dir):
+    """
+    Load the Product ID index of the cached product data
+    """
+    product_index_df = load_cache(cache_dir, PRODUCT_INDEX_CACHE)
+    return pd.Series(product_index_df[ROW].to_numpy(),
+                     index=pd.Index(np.asarray(product_index_df[PRODUCT_ID], dtype=object)), name=ROW)
+
+
+def product_rows(product_ids, product_index):
+    """
+    Row position of every Product ID in the indexed data, -1 for unknown products.
+    Only distinct Product IDs are looked up, rows of all values are then gathered from
+    their categorical codes by integer take
+    """
+    product_ids = pd.Categorical(product_ids)
+    positions = product_index.index.get_indexer(np.asarray(product_ids.categories, dtype=object))
+    category_rows = np.append(np.where(positions >= 0, product_index.to_numpy()[positions], -1), -1)
+    # code -1 (missing Product ID) takes the trailing -1
+    return category_rows[product_ids.codes]
+
+
+def take_product_columns(review_metadata_df, rows, columns, index=None):
+    """
+    Columns of the product data at the given row positions, missing where the row is -1
+    """
+    return pd.DataFrame({column: pd.api.extensions.take(review_metadata_df[column].array, rows, allow_fill=True)
+                         for column in columns},
+                        index=index)
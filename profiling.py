@@ -0,0 +1,101 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak memory is not recorded
+    resource = None
+
+# profiling state of the current process, stages are only recorded when enabled
+_PROFILE = {'enabled': False,
+            'stages': [],
+            'records': []}
+
+
+def enable_profiling(enabled=True):
+    """
+    Turn stage profiling on or off for the current process
+    """
+    _PROFILE['enabled'] = enabled
+
+
+def is_profiling_enabled():
+    """
+    Check whether stage profiling is on for the current process
+    """
+    return _PROFILE['enabled']
+
+
+def _peak_rss_mb():
+    """
+    Peak resident set size of the current process so far, in MB (ru_maxrss is in KB on Linux),
+    None where it is not available
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextmanager
+def profile_stage(name):
+    """
+    Record wall time, CPU time and the peak RSS of the process at the end of a named stage of the pipeline.
+    The peak RSS is over the lifetime of the process, so it only rises after the stage using the most memory.
+    Yields a dict in which the stage can record the number of rows it processed, e.g.
+        with profile_stage('parse_helpfulness') as stage:
+            ...
+            stage['rows'] = len(df.index)
+    Stages can be nested, the enclosing stage is recorded as parent
+    """
+    if not _PROFILE['enabled']:
+        yield {}
+        return
+
+    record = {'stage': name,
+              'parent': _PROFILE['stages'][-1] if _PROFILE['stages'] else None,
+              'pid': os.getpid(),
+              'rows': None}
+    _PROFILE['stages'].append(name)
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        record['wall_time'] = time.perf_counter() - start_wall
+        record['cpu_time'] = time.process_time() - start_cpu
+        record['process_peak_rss_mb'] = _peak_rss_mb()
+        _PROFILE['stages'].pop()
+        _PROFILE['records'].append(record)
+
+
+def pop_profile_records():
+    """
+    Return and clear the stages recorded so far, e.g. to send them from a worker process to the parent
+    """
+    records = _PROFILE['records']
+    _PROFILE['records'] = []
+    return records
+
+
+def add_profile_records(records):
+    """
+    Add stages recorded in another process
+    """
+    _PROFILE['records'].extend(records)
+
+
+def write_profile_report(filename):
+    """
+    Save recorded stages as JSON or CSV depending on the file extension
+    """
+    records = _PROFILE['records']
+    if filename.endswith('.csv'):
+        columns = ['stage', 'parent', 'pid', 'rows', 'wall_time', 'cpu_time', 'process_peak_rss_mb']
+        pd.DataFrame(records, columns=columns).astype({'rows': 'Int64'}).to_csv(filename, index=False)
+    else:
+        with open(filename, 'w') as f:
+            json.dump(records, f, indent=2)
@@ -0,0 +1,455 @@
+import argparse
+import io
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import matplotlib
+
+from main import *
+from main import _bought_together_edges
+from memoize import _input_fingerprint
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8050
+# number of query results kept in memory, least recently used results are removed first
+DEFAULT_MAX_RESULTS = 1024
+# query result formats
+JSON_FORMAT = 'json'
+PNG_FORMAT = 'png'
+CONTENT_TYPES = {JSON_FORMAT: 'application/json', PNG_FORMAT: 'image/png'}
+# data derived once when the data is loaded, shared by queries with different parameters
+# - flattened pairs of products bought together (see _bought_together_edges)
+# - aggregates per month over all products (see period_rollup)
+BOUGHT_TOGETHER_EDGES = 'bought_together_edges'
+MONTH_AGGREGATES = 'month'
+
+# state of the server process
+# - sampled : the data is a sample of the reviews (main.py --approx)
+# - data : inputs of all analyses (see load_analysis_data), loaded once and shared by all requests
+# - fingerprint : version of the cache entries the data was loaded from
+# - results : futures of query results by query, format and parameters, in order of last use
+_SERVER = {'cache_dir': None,
+           'sampled': False,
+           'years': None,
+           'data': None,
+           'fingerprint': None,
+           'loaded': None,
+           'results': OrderedDict(),
+           'max_results': DEFAULT_MAX_RESULTS,
+           'num_requests': 0}
+# data is swapped under the data lock on reload, pyplot state is global so plots are rendered one at a time
+_LOCKS = {'data': threading.Lock(),
+          'results': threading.Lock(),
+          'plot': threading.Lock()}
+
+
+class QueryError(ValueError):
+    """
+    Invalid query, reported to the client with status 400
+    """
+
+
+def _analysis_inputs():
+    """
+    Names of the cache entries and aggregate levels loaded by the server
+    """
+    return sorted(set(data_name for data_names in ANALYSIS_INPUTS.values() for data_name in data_names))
+
+
+def load_server_data(cache_dir, years=None, max_results=DEFAULT_MAX_RESULTS):
+    """
+    Load the inputs of all analyses from the pre-processed data in cache_dir and forget previous
+    query results. years=(first, last) restricts aggregates per period to these years
+    """
+    data = load_analysis_data(cache_dir, ANALYSIS_TYPES, years=years)
+    data[BOUGHT_TOGETHER_EDGES] = _bought_together_edges(data[PRODUCT_AGGREGATES], data[METADATA_CACHE])
+    data[MONTH_AGGREGATES] = period_rollup(data[MONTH_PRODUCT_AGGREGATES], MONTH, by=None)
+    with _LOCKS['data'], _LOCKS['results']:
+        _SERVER.update({'cache_dir': cache_dir,
+                        'years': years,
+                        'data': data,
+                        'fingerprint': _input_fingerprint(cache_dir, _analysis_inputs()),
+                        'loaded': time.time(),
+                        'max_results': max_results})
+        _SERVER['results'].clear()
+    return data
+
+
+def _parameter(params, name, kind=str, default=None, choices=None, minimum=None):
+    """
+    Value of a query parameter converted to kind, default if it is not given.
+    Values not in choices or below minimum are invalid
+    """
+    if name not in params:
+        return default
+    try:
+        value = kind(params[name])
+    except ValueError:
+        raise QueryError(f'invalid value of {name}: {params[name]}')
+    if choices is not None and value not in choices:
+        raise QueryError(f'{name} must be one of {", ".join(map(str, choices))}')
+    if minimum is not None and value < minimum:
+        raise QueryError(f'{name} must be at least {minimum}')
+    return value
+
+
+def _records(df):
+    """
+    Rows of a dataframe as JSON compatible dicts, missing values as None
+    """
+    return json.loads(df.to_json(orient='records', date_format='iso'))
+
+
+def _number(value):
+    """
+    JSON compatible float, None if missing
+    """
+    return None if value is None or np.isnan(value) else float(value)
+
+
+def _correlation(df, x, y, num_bootstrap=None):
+    """
+    Correlation between 2 columns of a dataframe with an optional bootstrap confidence interval
+    (see print_correlation)
+    """
+    df = df[df[x].notna() & df[y].notna()]
+    result = {'correlation': _number(df[x].corr(df[y]))}
+    if num_bootstrap is not None:
+        result['interval'] = [_number(bound) for bound in bootstrap_correlation(df[x], df[y], num_bootstrap,
+                                                                                random_state=0)]
+    return result
+
+
+# Queries take the analysis data and query parameters and return a JSON compatible result
+# and a plot task (plot function, args, kwargs), or None when the query has no plot
+
+def query_review_behavior_by_category(data, params):
+    """
+    Top categories by # of reviews, sorted by average metric (Q2)
+    - metric : aggregated metric, rating by default
+    - num_top_categories : 10 by default
+    - num_bootstrap : add bootstrap confidence intervals from this many resamples
+    """
+    metric = _parameter(params, 'metric', default=RATING, choices=AGGREGATE_METRICS)
+    num_bootstrap = _parameter(params, 'num_bootstrap', int, minimum=1)
+    num_top_categories = _parameter(params, 'num_top_categories', int, 10, minimum=1)
+    category_df = review_behavior_by_category(data[CATEGORY_AGGREGATES], metric,
+                                              num_top_categories=num_top_categories,
+                                              product_aggregates_df=data[PRODUCT_AGGREGATES],
+                                              num_bootstrap=num_bootstrap, sampled=_SERVER['sampled'])
+    return _records(category_df), (bar_plot, (category_df, CATEGORY, f'{metric}_mean'), {'xticks_rotation': 90})
+
+
+def query_average_metric_with_price(data, params):
+    """
+    Price and average metric of every product and their correlation (Q3)
+    - metric : aggregated metric, review word count by default
+    - category : only products of this category
+    - limit : max # of products returned or plotted, 1000 by default
+    - num_bootstrap : add a bootstrap confidence interval of the correlation from this many resamples
+    """
+    metric = _parameter(params, 'metric', default=REVIEW_WORD_COUNT, choices=AGGREGATE_METRICS)
+    limit = _parameter(params, 'limit', int, 1000, minimum=1)
+    product_df = get_average_metric_with_price(data[PRODUCT_AGGREGATES], metric)
+    category = _parameter(params, 'category', choices=sorted(product_df[CATEGORY].dropna().astype(str).unique()))
+    if category is not None:
+        product_df = product_df[product_df[CATEGORY] == category]
+
+    result = {'num_products': len(product_df.index),
+              **_correlation(product_df, PRICE, f'{metric}_mean',
+                             _parameter(params, 'num_bootstrap', int, minimum=1)),
+              'products': _records(product_df.head(limit))}
+    return result, (reg_plot, (product_df, PRICE, f'{metric}_mean'), {'max_samples': limit})
+
+
+def query_reviewer_summary(data, params):
+    """
+    Distribution of the average price of reviewed products and # of reviews per reviewer (Q4)
+    - limit : also return this many reviewers with the most reviews, 0 by default
+    """
+    summary_df = reviewer_summary(data[REVIEWER_AGGREGATES])
+    statistics_df = summary_df.describe()
+    result = {'num_reviewers': len(summary_df.index),
+              **_correlation(summary_df, f'{PRICE}_mean', 'Number of Reviews'),
+              'statistics': {column: {name: _number(value) for name, value in statistics_df[column].items()}
+                             for column in statistics_df.columns}}
+    limit = _parameter(params, 'limit', int, 0, minimum=0)
+    if limit > 0:
+        top_df = summary_df.nlargest(limit, 'Number of Reviews')
+        top_df.insert(0, REVIEWER_ID, data[REVIEWER_AGGREGATES][REVIEWER_ID].loc[top_df.index].astype(str))
+        result['reviewers'] = _records(top_df)
+    return result, (binned_joint_plot, (density_bins(summary_df[f'{PRICE}_mean'],
+                                                     summary_df['Number of Reviews']),), {})
+
+
+def query_bought_together(data, params):
+    """
+    Random pairs of products bought together with their average ratings, and the correlation
+    of these ratings (Q5)
+    - num_samples : 1000 by default
+    - random_state : 0 by default, so that repeated queries return the same sample
+    - num_bootstrap : add a bootstrap confidence interval of the correlation from this many resamples
+    """
+    num_samples = _parameter(params, 'num_samples', int, 1000, minimum=1)
+    rating_pair_df = sample_products_bought_together(data[PRODUCT_AGGREGATES], data[METADATA_CACHE],
+                                                     num_samples=num_samples,
+                                                     random_state=_parameter(params, 'random_state', int, 0,
+                                                                             minimum=0),
+                                                     edges=data[BOUGHT_TOGETHER_EDGES])
+    result = {**_correlation(rating_pair_df, 'Rating_1', 'Rating_2',
+                             _parameter(params, 'num_bootstrap', int, minimum=1)),
+              'pairs': _records(rating_pair_df)}
+    return result, (joint_plot, (rating_pair_df, 'Rating_1', 'Rating_2'), {'max_samples': 1000, 'alpha': 0.25})
+
+
+def query_correlation(data, params):
+    """
+    Correlations of review columns and price over all reviews (Q1), from the moments accumulated
+    when the reviews were pre-processed
+    - x, y : a pair of columns, all pairs by default
+    - num_bootstrap : add a bootstrap confidence interval of the correlation of a pair of review columns
+      from this many resamples
+    """
+    correlation_df = correlation_matrix(data[MOMENTS_CACHE])
+    columns = correlation_df.columns.tolist()
+    x, y = _parameter(params, 'x', choices=columns), _parameter(params, 'y', choices=columns)
+    if x is None and y is None:
+        return {column: {other: _number(value) for other, value in correlation_df[column].items()}
+                for column in columns}, None
+    if x is None or y is None:
+        raise QueryError('x and y must be given together')
+
+    result = {'x': x, 'y': y, 'correlation': _number(correlation_df.loc[x, y])}
+    num_bootstrap = _parameter(params, 'num_bootstrap', int, minimum=1)
+    if num_bootstrap is not None:
+        review_df = data[REVIEW_CACHE]
+        if x not in review_df.columns or y not in review_df.columns:
+            raise QueryError(f'confidence intervals are available for {", ".join(Q1_REVIEW_COLUMNS)}')
+        result['interval'] = _correlation(review_df, x, y, num_bootstrap)['interval']
+    return result, None
+
+
+def query_trend(data, params):
+    """
+    # of reviews and average metrics per year or month over all products (Q6)
+    - period : year (default) or month
+    - first_year, last_year : only these years, within those loaded by the server
+    - metric : plotted metric, rating by default
+    """
+    period = _parameter(params, 'period', default=YEAR, choices=[YEAR, MONTH])
+    metric = _parameter(params, 'metric', default=RATING, choices=AGGREGATE_METRICS)
+    month_df = data[MONTH_AGGREGATES]
+    first_year = _parameter(params, 'first_year', int, month_df[YEAR].min())
+    last_year = _parameter(params, 'last_year', int, month_df[YEAR].max(), minimum=first_year)
+
+    trend_df = period_trend(month_df[month_df[YEAR].between(first_year, last_year)], period)
+    x = 'period' if period == MONTH else YEAR
+    return _records(trend_df), (line_plot, (trend_df, x, f'{metric}_mean'), {'xlabel': period.title()})
+
+
+# queries by path, with the formats of their results
+QUERIES = {'review_behavior_by_category': (query_review_behavior_by_category, [JSON_FORMAT, PNG_FORMAT]),
+           'average_metric_with_price': (query_average_metric_with_price, [JSON_FORMAT, PNG_FORMAT]),
+           'reviewer_summary': (query_reviewer_summary, [JSON_FORMAT, PNG_FORMAT]),
+           'bought_together': (query_bought_together, [JSON_FORMAT, PNG_FORMAT]),
+           'correlation': (query_correlation, [JSON_FORMAT]),
+           'trend': (query_trend, [JSON_FORMAT, PNG_FORMAT])}
+
+
+def _render(plot_task):
+    """
+    Render a plot task of a query to PNG bytes
+    """
+    plot_function, plot_args, plot_kwargs = plot_task
+    buffer = io.BytesIO()
+    with _LOCKS['plot']:
+        # plot functions save to any file name or file object
+        plot_function(buffer, *plot_args, **plot_kwargs)
+    return buffer.getvalue()
+
+
+def _compute(name, result_format, params, data):
+    """
+    Run a query on the analysis data and encode its result
+    """
+    query_function, _ = QUERIES[name]
+    result, plot_task = query_function(data, params)
+    if result_format == PNG_FORMAT:
+        return _render(plot_task)
+    return json.dumps(result).encode('utf-8')
+
+
+def run_query(name, params):
+    """
+    Result of a query as bytes in its format (params['format'], JSON by default).
+    Results are kept in memory, concurrent requests for the same result wait for a single computation
+    """
+    if name not in QUERIES:
+        raise KeyError(name)
+    params = dict(params)
+    result_format = params.pop('format', JSON_FORMAT)
+    if result_format not in QUERIES[name][1]:
+        raise QueryError(f'{name} results are available as {", ".join(QUERIES[name][1])}')
+
+    key = (name, result_format, tuple(sorted(params.items())))
+    with _LOCKS['data']:
+        data = _SERVER['data']
+    with _LOCKS['results']:
+        future = _SERVER['results'].get(key)
+        compute = future is None
+        if compute:
+            future = _SERVER['results'][key] = Future()
+            while len(_SERVER['results']) > _SERVER['max_results']:
+                _SERVER['results'].popitem(last=False)
+        else:
+            _SERVER['results'].move_to_end(key)
+
+    if compute:
+        try:
+            future.set_result(_compute(name, result_format, params, data))
+        except Exception as error:
+            future.set_exception(error)
+            # failed queries are not kept, e.g. so that a reload can fix them
+            with _LOCKS['results']:
+                if _SERVER['results'].get(key) is future:
+                    del _SERVER['results'][key]
+    return future.result(), CONTENT_TYPES[result_format]
+
+
+def server_status():
+    """
+    Loaded data, whether it is still the current version of the pre-processed data, and request counts
+    """
+    with _LOCKS['data']:
+        cache_dir, data, fingerprint = _SERVER['cache_dir'], _SERVER['data'], _SERVER['fingerprint']
+    return {'cache_dir': cache_dir,
+            'sampled': _SERVER['sampled'],
+            'years': _SERVER['years'],
+            'loaded': _SERVER['loaded'],
+            'up_to_date': fingerprint == _input_fingerprint(cache_dir, _analysis_inputs()),
+            'inputs': {name: len(value.index) for name, value in data.items() if isinstance(value, pd.DataFrame)},
+            'num_requests': _SERVER['num_requests'],
+            'num_results': len(_SERVER['results']),
+            'queries': {name: formats for name, (_, formats) in QUERIES.items()}}
+
+
+class AnalysisRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP interface of the analysis server
+    - GET /{query}?param=value&format=json|png : run a query, see QUERIES
+    - GET /status : see server_status
+    - POST /reload : reload the pre-processed data, e.g. after main.py --append_reviews
+    """
+    # keep-alive connections, so that batch clients do not reconnect for every request
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, status, body, content_type=CONTENT_TYPES[JSON_FORMAT]):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, value):
+        self._send(status, json.dumps(value).encode('utf-8'))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        name = url.path.strip('/')
+        # repeated parameters keep their last value
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        with _LOCKS['results']:
+            _SERVER['num_requests'] += 1
+        if name == 'status':
+            self._send_json(200, server_status())
+            return
+        if name not in QUERIES:
+            self._send_json(404, {'error': f'unknown query {name}', 'queries': list(QUERIES)})
+            return
+        try:
+            body, content_type = run_query(name, params)
+        except QueryError as error:
+            self._send_json(400, {'error': str(error)})
+        except Exception as error:
+            self._send_json(500, {'error': f'{type(error).__name__}: {error}'})
+        else:
+            self._send(200, body, content_type)
+
+    def do_POST(self):
+        if urlparse(self.path).path.strip('/') != 'reload':
+            self._send_json(404, {'error': 'only /reload accepts POST requests'})
+            return
+        start = time.time()
+        try:
+            load_server_data(_SERVER['cache_dir'], years=_SERVER['years'], max_results=_SERVER['max_results'])
+        except Exception as error:
+            # the data loaded before is kept
+            self._send_json(500, {'error': f'{type(error).__name__}: {error}'})
+        else:
+            self._send_json(200, {'reload_time': time.time() - start})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class AnalysisServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server with a listen backlog large enough for batch clients opening many connections
+    at once, connections beyond the backlog are only retried after a timeout (about 1s)
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def serve(cache_dir, host=DEFAULT_HOST, port=DEFAULT_PORT, years=None, max_results=DEFAULT_MAX_RESULTS,
+          verbose=False, sampled=False):
+    """
+    Load the pre-processed data once and create a threaded HTTP server answering queries from it,
+    one thread per connection. sampled tells that the data is a sample of the reviews (main.py --approx).
+    Returns the server, call serve_forever to start it
+    """
+    matplotlib.use('Agg')
+    _SERVER['sampled'] = sampled
+    load_server_data(cache_dir, years=years, max_results=max_results)
+    server = AnalysisServer((host, port), AnalysisRequestHandler)
+    server.verbose = verbose
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, nargs='?', default='data',
+                        help='Data folder path, pre-processed data is read from its cache (see main.py)')
+    parser.add_argument('--approx', type=float, nargs='?', const=DEFAULT_SAMPLE_FRACTION, default=None,
+                        help='Serve the sample of this fraction of the reviews pre-processed with main.py --approx')
+    parser.add_argument('--host', type=str, nargs='?', default=DEFAULT_HOST,
+                        help='Address to listen on')
+    parser.add_argument('--port', type=int, nargs='?', default=DEFAULT_PORT,
+                        help='Port to listen on')
+    parser.add_argument('--years', type=int, nargs=2, default=None, metavar=('FIRST', 'LAST'),
+                        help='Only load aggregates over time (trend queries) of this range of years')
+    parser.add_argument('--max_results', type=int, nargs='?', default=DEFAULT_MAX_RESULTS,
+                        help='Number of query results kept in memory')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Log every request')
+    args = parser.parse_args()
+
+    CACHE_DIR = os.path.join(args.data_dir, CACHE_DIR_NAME)
+    if args.approx is not None:
+        CACHE_DIR = f'{CACHE_DIR}_approx{args.approx:g}'
+    start = time.time()
+    server = serve(CACHE_DIR, host=args.host, port=args.port, years=args.years, max_results=args.max_results,
+                   verbose=args.verbose, sampled=args.approx is not None)
+    print(f'Loaded {CACHE_DIR} in {time.time() - start:.1f}s, serving on http://{args.host}:{server.server_port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
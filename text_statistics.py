@@ -0,0 +1,183 @@
+import os
+import numpy as np
+
+# statistics computed by text_statistics
+# - words : # of whitespace separated words, as len(text.split())
+# - characters : # of characters, as len(text)
+# - sentences : # of sentences, i.e. the first word and every word following a word which ends
+#   with a sentence terminator
+NUM_WORDS = 'words'
+NUM_CHARACTERS = 'characters'
+NUM_SENTENCES = 'sentences'
+
+
+def _multibyte_whitespace():
+    """
+    UTF-8 sequences of the non-ASCII whitespace characters (all in the basic multilingual plane),
+    as big-endian integers by sequence length
+    """
+    sequences = {}
+    for code in range(0x80, 0x10000):
+        if chr(code).isspace():
+            sequence = chr(code).encode('utf-8')
+            sequences.setdefault(len(sequence), []).append(int.from_bytes(sequence, 'big'))
+    return sequences
+
+
+# whitespace of str.split in UTF-8
+# - ASCII : \t\n\v\f\r, \x1c-\x1f and space, as inclusive byte ranges
+# - other : 2 and 3 byte sequences, e.g. no-break space and ideographic space
+ASCII_WHITESPACE_RANGES = [(0x09, 0x0d), (0x1c, 0x20)]
+MULTIBYTE_WHITESPACE = _multibyte_whitespace()
+SENTENCE_TERMINATORS = list(b'.!?')
+# texts are processed in batches of about this many bytes, so that intermediate arrays stay in the CPU cache
+TEXT_BATCH_BYTES = 2 ** 20
+
+# files of a shard of the text store (see write_text_shard)
+TEXT_SHARD_DATA = '{}.bin'
+TEXT_SHARD_OFFSETS = '{}.offsets.npy'
+
+
+def encode_texts(texts):
+    """
+    Encode a column of texts into a single buffer of UTF-8 bytes, text i is buffer[offsets[i]:offsets[i + 1]].
+    Missing values are encoded as empty texts
+    """
+    encoded = [text.encode('utf-8') for text in texts.fillna('').tolist()]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)), out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def decode_texts(buffer, offsets, rows):
+    """
+    Texts of the given rows of an encoded buffer (see encode_texts)
+    """
+    return [bytes(buffer[offsets[row]:offsets[row + 1]]).decode('utf-8') for row in rows]
+
+
+def _word_mask(buffer):
+    """
+    Mark every byte of a non-whitespace character of a UTF-8 buffer, also returns the positions of
+    the lead bytes of multibyte characters
+    """
+    is_word = buffer > 0x20
+    # bytes below 0x1c (only \t\n\v\f\r are whitespace) or multibyte lead bytes (>= 0xc2),
+    # both rare in most texts, found in one pass since the subtraction wraps bytes below 0x1c around
+    rare = np.flatnonzero((buffer - np.uint8(0x1c)) >= 0xc2 - 0x1c)
+    rare_bytes = buffer[rare]
+    controls = rare[rare_bytes < 0x1c]
+    is_word[controls] = ~np.any([(buffer[controls] - np.uint8(first)) <= last - first
+                                 for first, last in ASCII_WHITESPACE_RANGES], axis=0)
+
+    leads = rare[rare_bytes >= 0xc2]
+    for length, sequences in MULTIBYTE_WHITESPACE.items():
+        starts = leads[leads + length <= len(buffer)]
+        sequence = np.zeros(len(starts), dtype=np.int64)
+        for i in range(length):
+            sequence = sequence * 256 + buffer[starts + i]
+        starts = starts[np.isin(sequence, sequences)]
+        for i in range(length):
+            is_word[starts + i] = False
+    return is_word, leads
+
+
+def _per_text(positions, offsets, values=None):
+    """
+    Number of (sorted) buffer positions within every text of an encoded buffer,
+    or sum of their values if given
+    """
+    bounds = np.searchsorted(positions, offsets)
+    if values is None:
+        return np.diff(bounds)
+    return np.diff(np.append(0, np.cumsum(values))[bounds])
+
+
+def _batch_statistics(buffer, offsets, statistics):
+    """
+    Statistics of every text of an encoded buffer, see text_statistics
+    """
+    is_word, leads = _word_mask(buffer)
+    non_empty = offsets[:-1] < offsets[1:]
+    first_bytes, last_bytes = offsets[:-1][non_empty], offsets[1:][non_empty] - 1
+
+    result = {}
+    if NUM_WORDS in statistics:
+        # words start after whitespace or at the start of a text
+        word_starts = np.empty(len(buffer), dtype=bool)
+        np.greater(is_word[1:], is_word[:-1], out=word_starts[1:])
+        word_starts[first_bytes] = is_word[first_bytes]
+        result[NUM_WORDS] = np.zeros(len(offsets) - 1, dtype=np.int32)
+        if len(first_bytes):
+            result[NUM_WORDS][non_empty] = np.add.reduceat(word_starts, first_bytes, dtype=np.int32)
+    if NUM_CHARACTERS in statistics:
+        # characters of 2, 3 and 4 bytes have lead bytes 0xc2 - 0xdf, 0xe0 - 0xef and 0xf0 - 0xf4
+        continuation_bytes = 1 + (buffer[leads] >= 0xe0) + (buffer[leads] >= 0xf0)
+        result[NUM_CHARACTERS] = (np.diff(offsets) - _per_text(leads, offsets, continuation_bytes)).astype(np.int32)
+    if NUM_SENTENCES in statistics:
+        # words end before whitespace or at the end of a text
+        word_ends = np.empty(len(buffer), dtype=bool)
+        np.greater(is_word[:-1], is_word[1:], out=word_ends[:-1])
+        word_ends[last_bytes] = is_word[last_bytes]
+        word_ends = np.flatnonzero(word_ends)
+        terminated = np.isin(buffer[word_ends], SENTENCE_TERMINATORS)
+        # the first word and every word following a terminated word, i.e. one sentence per terminated word
+        # except the last word of the text, plus one if the text has words
+        bounds = np.searchsorted(word_ends, offsets)
+        num_words = np.diff(bounds)
+        last_terminated = np.zeros(len(num_words), dtype=bool)
+        last_terminated[num_words > 0] = terminated[bounds[1:][num_words > 0] - 1]
+        result[NUM_SENTENCES] = ((num_words > 0) + _per_text(word_ends, offsets, terminated)
+                             - last_terminated).astype(np.int32)
+    return result
+
+
+def text_statistics(buffer, offsets, statistics=(NUM_WORDS, NUM_CHARACTERS, NUM_SENTENCES)):
+    """
+    Statistics of every text of an encoded buffer (see encode_texts), computed with array operations
+    over batches of texts of about TEXT_BATCH_BYTES rather than text by text. Returns a dict of int32 arrays
+    - NUM_WORDS : # of whitespace separated words, as len(text.split())
+    - NUM_CHARACTERS : # of characters, as len(text)
+    - NUM_SENTENCES : # of sentences, the first word and every word following a word which ends with . ! or ?
+    """
+    num_texts = len(offsets) - 1
+    # first text of every batch, texts longer than a batch make a batch of their own
+    bounds = np.searchsorted(offsets, np.arange(0, offsets[-1], TEXT_BATCH_BYTES), side='right') - 1
+    bounds = np.unique(np.concatenate([[0], bounds, [num_texts]]))
+    batches = [_batch_statistics(buffer[offsets[start]:offsets[end]], offsets[start:end + 1] - offsets[start],
+                                 statistics)
+               for start, end in zip(bounds[:-1], bounds[1:])]
+    return {statistic: np.concatenate([batch[statistic] for batch in batches] + [np.zeros(0, dtype=np.int32)])
+            for statistic in statistics}
+
+
+def _shard_paths(store_dir, shard):
+    """
+    Paths of the data and offsets files of a text store shard
+    """
+    return (os.path.join(store_dir, TEXT_SHARD_DATA.format(shard)),
+            os.path.join(store_dir, TEXT_SHARD_OFFSETS.format(shard)))
+
+
+def write_text_shard(store_dir, shard, buffer, offsets):
+    """
+    Save an encoded buffer (see encode_texts) as a shard of a text store folder, raw bytes and offsets
+    in separate files so that they can be memory mapped
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    data_path, offsets_path = _shard_paths(store_dir, shard)
+    buffer.tofile(data_path)
+    np.save(offsets_path, offsets)
+
+
+def read_text_shard(store_dir, shard):
+    """
+    Memory map a shard of a text store folder, returns its buffer and offsets
+    """
+    data_path, offsets_path = _shard_paths(store_dir, shard)
+    offsets = np.load(offsets_path, mmap_mode='r')
+    # empty files cannot be memory mapped
+    if offsets[-1] == 0:
+        return np.zeros(0, dtype=np.uint8), offsets
+    return np.memmap(data_path, dtype=np.uint8, mode='r'), offsets
+
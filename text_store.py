@@ -0,0 +1,127 @@
+import argparse
+import glob
+import os
+import time
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from tabulate import tabulate
+
+from load_data import *
+from cache import *
+
+# raw review text and summaries, saved while raw reviews are processed with main.py --text_store
+# - text_store/{field}.{shard}.bin : UTF-8 bytes of the texts of a shard, one after the other
+# - text_store/{field}.{shard}.offsets.npy : start of every text of the shard and end of the last one
+# - TEXT_STORE_CACHE : cache entry listing the shards of every field in the order of the review cache
+TEXT_STORE_DIR_NAME = 'text_store'
+TEXT_STORE_CACHE = 'text_store_shards'
+TEXT_STORE_FIELDS = list(REVIEW_TEXT_STATISTICS)
+FIELD = 'field'
+SHARD = 'shard'
+NUM_TEXTS = 'num_texts'
+
+
+def text_store_dir(cache_dir):
+    """
+    Folder of the text store of a cache folder
+    """
+    return os.path.join(cache_dir, TEXT_STORE_DIR_NAME)
+
+
+def clear_text_store(cache_dir):
+    """
+    Remove all shards of the text store, before it is rebuilt
+    """
+    for filename in glob.glob(os.path.join(text_store_dir(cache_dir), '*')):
+        os.remove(filename)
+
+
+def save_text_store(cache_dir, source_files):
+    """
+    List the shards written to the text store (in the order of their names, which is the order of
+    the reviews) and save the list to the cache. Returns the list
+    """
+    records = []
+    for field in TEXT_STORE_FIELDS:
+        pattern = os.path.join(text_store_dir(cache_dir), TEXT_SHARD_OFFSETS.format(f'{field}.*'))
+        for offsets_path in sorted(glob.glob(pattern)):
+            shard = os.path.basename(offsets_path)[:-len(TEXT_SHARD_OFFSETS.format(''))]
+            records.append({FIELD: field, SHARD: shard, NUM_TEXTS: len(np.load(offsets_path, mmap_mode='r')) - 1})
+    shards_df = pd.DataFrame(records, columns=[FIELD, SHARD, NUM_TEXTS])
+    shards_df[[FIELD, SHARD]] = shards_df[[FIELD, SHARD]].astype('category')
+    save_cache(cache_dir, TEXT_STORE_CACHE, [shards_df], source_files)
+    return shards_df
+
+
+def is_text_store_valid(cache_dir, source_files):
+    """
+    Check that the text store was built from the current raw data files and has the texts of every
+    review of the cache, including reviews appended after it was built (see ingest_new_reviews)
+    """
+    if not is_cache_valid(cache_dir, TEXT_STORE_CACHE, source_files):
+        return False
+    num_reviews = sum(pq.ParquetFile(filename).metadata.num_rows for filename in cache_files(cache_dir, REVIEW_CACHE))
+    num_texts = load_cache(cache_dir, TEXT_STORE_CACHE).groupby(FIELD, observed=True)[NUM_TEXTS].sum()
+    return all(num_texts.get(field, 0) == num_reviews for field in TEXT_STORE_FIELDS)
+
+
+def iter_texts(cache_dir, field):
+    """
+    Iterate over the shards of a field of the text store in the order of the reviews, as memory mapped
+    buffers and offsets (see encode_texts)
+    """
+    shards_df = load_cache(cache_dir, TEXT_STORE_CACHE)
+    for shard in shards_df.loc[shards_df[FIELD] == field, SHARD]:
+        yield read_text_shard(text_store_dir(cache_dir), shard)
+
+
+def load_texts(cache_dir, field, rows):
+    """
+    Texts of a field for the given rows of the review cache, only the bytes of these texts are read
+    """
+    shards_df = load_cache(cache_dir, TEXT_STORE_CACHE)
+    shards_df = shards_df[shards_df[FIELD] == field]
+    first_rows = np.append(0, np.cumsum(shards_df[NUM_TEXTS].to_numpy()))
+    rows = np.asarray(rows)
+    shard_ids = np.searchsorted(first_rows, rows, side='right') - 1
+
+    texts = np.empty(len(rows), dtype=object)
+    for shard_id in np.unique(shard_ids):
+        buffer, offsets = read_text_shard(text_store_dir(cache_dir), shards_df[SHARD].iloc[shard_id])
+        selected = shard_ids == shard_id
+        texts[selected] = decode_texts(buffer, offsets, rows[selected] - first_rows[shard_id])
+    return texts.tolist()
+
+
+def text_store_statistics(cache_dir, field, statistics=(NUM_WORDS, NUM_CHARACTERS, NUM_SENTENCES)):
+    """
+    Statistics of a field for every review of the cache (see text_statistics), computed from
+    the text store rather than the raw data files, one shard at a time
+    """
+    results = [text_statistics(buffer, offsets, statistics) for buffer, offsets in iter_texts(cache_dir, field)]
+    return pd.DataFrame({statistic: np.concatenate([result[statistic] for result in results]
+                                                   + [np.zeros(0, dtype=np.int32)])
+                         for statistic in statistics})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', type=str, choices=['show', 'statistics'],
+                        help='Show texts of some reviews, or compute text statistics of all reviews')
+    parser.add_argument('--cache_dir', type=str, nargs='?', default=os.path.join('data', CACHE_DIR_NAME),
+                        help='Pre-processed data folder the text store was saved in')
+    parser.add_argument('--field', type=str, nargs='?', default=REVIEW_TEXT, choices=TEXT_STORE_FIELDS,
+                        help='Text field')
+    parser.add_argument('--rows', type=int, nargs='+', default=[0],
+                        help='Rows of the review cache to show')
+    args = parser.parse_args()
+
+    if args.command == 'show':
+        for row, text in zip(args.rows, load_texts(args.cache_dir, args.field, args.rows)):
+            print(f'[{row}] {text}')
+    else:
+        start = time.time()
+        statistics_df = text_store_statistics(args.cache_dir, args.field)
+        print(tabulate(statistics_df.describe().T, headers='keys', tablefmt='psql', floatfmt='.2f'))
+        print(f'{len(statistics_df.index)} texts in {time.time() - start:.1f}s')